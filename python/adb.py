@@ -3,15 +3,42 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import gdb, subprocess, readinput
+import gdb, subprocess, threading, hashlib, pipes, readinput
 
 returncode = 0
 
-def call(args, **kw):
-    cmd = [str(gdb.parameter('adb-path'))]
-    dev = str(gdb.parameter('adb-device'))
+# gdb parameters can only be read on the main thread, so adbparams
+# saves the adb command line here whenever adb-path or adb-device is set,
+# and all threads use it as is
+_command = ['adb']
+# device used by the current thread instead of adb-device, if any
+_local = threading.local()
+
+def setCommand(path, dev):
+    '''Save the adb command line used by all threads'''
+    global _command
+    cmd = [path or 'adb']
     if dev:
         cmd.extend(['-s', dev])
+    _command = cmd
+
+def command():
+    dev = getattr(_local, 'device', None)
+    if dev:
+        return [_command[0], '-s', dev]
+    return list(_command)
+
+def useDevice(dev):
+    '''Run adb commands from the calling thread on dev, regardless of
+    adb-device; None goes back to adb-device'''
+    _local.device = dev
+
+def getDevice():
+    cmd = command()
+    return cmd[2] if len(cmd) > 2 else ''
+
+def call(args, **kw):
+    cmd = command()
     cmd.extend(args)
     async = False
     if 'async' in kw:
@@ -73,7 +100,7 @@ def chooseDevice():
         print 'Found multiple devices:'
         for i in range(len(devs)):
             print '%d. %s' % (i + 1, devs[i])
-        dev = readinput.call('Choose device: ', '-l', str(devs))
+        dev = readinput.call('Choose device: ', '-l', devs)
         if dev.isdigit() and int(dev) > 0 and int(dev) <= len(devs):
             dev = devs[int(dev) - 1]
         elif len(dev) > 0:
@@ -104,6 +131,45 @@ def push(src, dest):
     params.append(dest)
     call(params, stderr=subprocess.PIPE)
 
+# checksums of files pushed or verified in this session, per device
+_pushed = {}
+
+def pushIfChanged(src, dest, mode='755'):
+    '''Push src to dest and chmod it, unless dest is already up to date
+
+    The checksum of src is kept on the device in dest.sha1, so an up to
+    date file costs one shell round trip instead of a push.
+    Returns True if src was pushed.'''
+    with open(src, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    key = (getDevice(), dest)
+    if _pushed.get(key) == digest:
+        return False
+    out = call(['shell', 'cat "%s.sha1" 2>/dev/null; '
+                'ls "%s" >/dev/null 2>&1 || echo missing' % (dest, dest)],
+               stderr=subprocess.PIPE)
+    changed = out.split() != [digest]
+    if changed:
+        push(src, dest)
+        call(['shell', 'chmod %s "%s" && echo %s > "%s.sha1"' %
+              (mode, dest, digest, dest)], stderr=subprocess.PIPE)
+    _pushed[key] = digest
+    return changed
+
+def writeIfChanged(data, dest, mode='755'):
+    '''Write the string data to dest and chmod it, unless dest is
+    already up to date; always one shell round trip at most'''
+    digest = hashlib.sha1(data).hexdigest()
+    key = (getDevice(), dest)
+    if _pushed.get(key) == digest:
+        return
+    call(['shell', '[ "$(cat "%(dest)s.sha1" 2>/dev/null)" = %(digest)s ] || '
+          '{ printf %%s %(data)s > "%(dest)s" && chmod %(mode)s "%(dest)s" '
+          '&& echo %(digest)s > "%(dest)s.sha1"; }' % {
+            'dest': dest, 'digest': digest, 'mode': mode,
+            'data': pipes.quote(data)}], stderr=subprocess.PIPE)
+    _pushed[key] = digest
+
 def pathExists(path):
     # adb shell doesn't seem to return error codes
     out = call(['shell', 'ls "' + path + '"; echo $?'],
@@ -113,3 +179,19 @@ def pathExists(path):
 def forward(from_port, to_port):
     call(['forward', from_port, to_port])
 
+
+# system properties per device; these do not change without a reboot
+_props = {}
+
+def getProp(name):
+    dev = getDevice()
+    if (dev, name) not in _props:
+        _props[(dev, name)] = call(['shell', 'getprop', name]).strip()
+    return _props[(dev, name)]
+
+def getFingerprint():
+    return getProp('ro.build.fingerprint')
+
+def getSdkVersion():
+    sdk = getProp('ro.build.version.sdk')
+    return int(sdk) if sdk.isdigit() else 0
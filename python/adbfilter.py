@@ -0,0 +1,197 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import re, time, threading
+
+# logcat priorities from lowest to highest
+PRIORITIES = 'VDIWEF'
+
+class Stage(object):
+    '''Base class for a stage in a log filter pipeline
+
+    A stage receives a list of entries and returns a list of entries.
+    Subclasses override process(); counters are kept by run().'''
+
+    def __init__(self, name=None):
+        self.name = name or self.__class__.__name__
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.entriesIn = 0
+        self.entriesOut = 0
+        self.elapsed = 0.0
+
+    def process(self, entries):
+        return entries
+
+    def run(self, entries):
+        start = time.time()
+        out = self.process(entries)
+        self.elapsed += time.time() - start
+        self.calls += 1
+        self.entriesIn += len(entries)
+        self.entriesOut += len(out)
+        return out
+
+    def __str__(self):
+        return '%-24s %8d in %8d out %10.3f ms %8.3f us/entry' % (
+                self.name[0: 24], self.entriesIn, self.entriesOut,
+                self.elapsed * 1000,
+                self.elapsed * 1000000 / self.entriesIn
+                    if self.entriesIn else 0)
+
+class FieldStage(Stage):
+    '''Keep (or with exclude=True, drop) entries where the given
+    member is one of the given values'''
+
+    def __init__(self, field, values, exclude=False, name=None):
+        super(FieldStage, self).__init__(name)
+        self.field = field
+        self.values = frozenset(str(v) for v in values)
+        self.exclude = exclude
+
+    def process(self, entries):
+        values = self.values
+        field = self.field
+        if self.exclude:
+            return [e for e in entries if getattr(e, field) not in values]
+        return [e for e in entries if getattr(e, field) in values]
+
+class TagStage(FieldStage):
+    '''Keep (or with exclude=True, drop) entries with the given tags'''
+
+    def __init__(self, tags, exclude=False, name=None):
+        super(TagStage, self).__init__('tag', tags, exclude, name)
+
+class PidStage(FieldStage):
+    '''Keep (or with exclude=True, drop) entries from the given pids'''
+
+    def __init__(self, pids, exclude=False, name=None):
+        super(PidStage, self).__init__('pid', pids, exclude, name)
+
+class ProcessStage(FieldStage):
+    '''Keep (or with exclude=True, drop) entries from processes with the
+    given names (e.g. 'org.mozilla.fennec')'''
+
+    def __init__(self, names, exclude=False, name=None):
+        super(ProcessStage, self).__init__('process', names, exclude, name)
+
+class ThreadStage(FieldStage):
+    '''Keep (or with exclude=True, drop) entries from threads with the
+    given names (e.g. 'Gecko', 'Compositor')'''
+
+    def __init__(self, names, exclude=False, name=None):
+        super(ThreadStage, self).__init__('thread', names, exclude, name)
+
+class PriorityStage(Stage):
+    '''Keep entries with at least the given priority (e.g. 'W')'''
+
+    def __init__(self, floor, name=None):
+        super(PriorityStage, self).__init__(name)
+        floor = floor.upper()
+        if floor not in PRIORITIES:
+            raise ValueError('invalid priority ' + floor)
+        self.priorities = frozenset(PRIORITIES[PRIORITIES.index(floor):])
+
+    def process(self, entries):
+        priorities = self.priorities
+        return [e for e in entries if e.priority in priorities]
+
+class RegexStage(Stage):
+    '''Keep (or with exclude=True, drop) entries where the regex matches
+
+    field is the name of the entry member to search.'''
+
+    def __init__(self, pattern, field='text', exclude=False,
+                 flags=0, name=None):
+        super(RegexStage, self).__init__(name)
+        self.regex = re.compile(pattern, flags)
+        self.field = field
+        self.exclude = exclude
+
+    def process(self, entries):
+        search = self.regex.search
+        field = self.field
+        if self.exclude:
+            return [e for e in entries if not search(getattr(e, field))]
+        return [e for e in entries if search(getattr(e, field))]
+
+class RewriteStage(Stage):
+    '''Substitute text in entries using re.sub()'''
+
+    def __init__(self, pattern, repl, field='text', flags=0, name=None):
+        super(RewriteStage, self).__init__(name)
+        self.regex = re.compile(pattern, flags)
+        self.repl = repl
+        self.field = field
+
+    def process(self, entries):
+        sub = self.regex.sub
+        repl = self.repl
+        field = self.field
+        return [e._replace(**{field: sub(repl, getattr(e, field))})
+                for e in entries]
+
+class CustomStage(Stage):
+    '''Run a Python function as a stage
+
+    If batch is False, fn is called for each entry and returns the entry,
+    a modified entry, or None to drop the entry. If batch is True, fn is
+    called with the list of entries and returns a list of entries.'''
+
+    def __init__(self, fn, batch=False, name=None):
+        super(CustomStage, self).__init__(name or getattr(fn, '__name__',
+                                                          None))
+        self.fn = fn
+        self.batch = batch
+
+    def process(self, entries):
+        if self.batch:
+            return self.fn(entries)
+        fn = self.fn
+        out = []
+        for e in entries:
+            e = fn(e)
+            if e:
+                out.append(e)
+        return out
+
+class Pipeline(object):
+    '''Ordered list of stages run on batches of log entries'''
+
+    def __init__(self, stages=None):
+        self._lock = threading.Lock()
+        self.stages = list(stages) if stages else []
+
+    def add(self, stage, index=None):
+        with self._lock:
+            stages = list(self.stages)
+            stages.insert(len(stages) if index is None else index, stage)
+            self.stages = stages
+        return stage
+
+    def remove(self, stage):
+        with self._lock:
+            self.stages = [s for s in self.stages if s is not stage]
+
+    def clear(self):
+        with self._lock:
+            self.stages = []
+
+    def run(self, entries):
+        # self.stages is replaced, never modified, so no locking here
+        for stage in self.stages:
+            if not entries:
+                break
+            entries = stage.run(entries)
+        return entries
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def __str__(self):
+        return '\n'.join(str(s) for s in self.stages)
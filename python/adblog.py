@@ -3,15 +3,109 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import gdb, adb, feninit, threading, sys, os, cStringIO, collections
+import gdb, adb, adbparams, adbfilter, cache, procmap, feninit
+import threading, subprocess, sys, os, time, re, sre_parse, signal
+import struct, collections
 
 ADBLogEntry = collections.namedtuple('ADBLogEntry',
-        ['date', 'time', 'pid', 'tid', 'priority', 'tag', 'text']);
+        ['date', 'time', 'pid', 'tid', 'priority', 'tag', 'text', 'buffer',
+         'process', 'thread']);
+
+# log buffers read when the device supports binary logcat output
+LOG_BUFFERS = ['main', 'system', 'crash', 'events']
+# log buffer names by id, from android/log.h
+LOG_BUFFER_IDS = ['main', 'radio', 'events', 'system', 'crash',
+                  'stats', 'security', 'kernel']
+# priority letters by value, from android/log.h
+LOG_PRIORITIES = ['', '', 'V', 'D', 'I', 'W', 'E', 'F', 'S']
+
+def _getEventTags():
+    # returns {'tag number': [tag name, [field names]]}
+    fingerprint = adb.getFingerprint()
+    name = 'event-log-tags-' + cache.key(fingerprint)
+    tags = cache.load(name)
+    if tags is not None:
+        return tags
+    tags = {}
+    out = adb.call(['shell', 'cat', '/system/etc/event-log-tags'])
+    for line in out.splitlines():
+        # line == 'NUMBER NAME (FIELD|TYPE[|UNIT]),...'
+        items = line.partition('#')[0].split(None, 2)
+        if len(items) < 2 or not items[0].isdigit():
+            continue
+        fields = re.findall(r'\(\s*([^|)]+?)\s*\|', items[2]) \
+                 if len(items) > 2 else []
+        tags[items[0]] = [items[1], fields]
+    cache.save(name, tags)
+    return tags
+
+def _decodeEventValue(payload, pos):
+    # returns (value, next position)
+    kind = ord(payload[pos])
+    pos += 1
+    if kind == 0: # int
+        return struct.unpack_from('<i', payload, pos)[0], pos + 4
+    if kind == 1: # long
+        return struct.unpack_from('<q', payload, pos)[0], pos + 8
+    if kind == 2: # string
+        size = struct.unpack_from('<I', payload, pos)[0]
+        return payload[pos + 4: pos + 4 + size], pos + 4 + size
+    if kind == 3: # list
+        count = ord(payload[pos])
+        pos += 1
+        values = []
+        for i in range(count):
+            value, pos = _decodeEventValue(payload, pos)
+            values.append(value)
+        return values, pos
+    if kind == 4: # float
+        return struct.unpack_from('<f', payload, pos)[0], pos + 4
+    raise ValueError('unknown event type %d' % kind)
+
+def _formatEvent(payload, tags):
+    # returns (tag, text)
+    if len(payload) < 4:
+        return '', ''
+    tagnum = str(struct.unpack_from('<I', payload, 0)[0])
+    tag, fields = tags.get(tagnum, [tagnum, []])
+    try:
+        value = _decodeEventValue(payload, 4)[0] if len(payload) > 4 else ''
+    except (ValueError, IndexError, struct.error):
+        return tag, '<invalid event payload>'
+    if not isinstance(value, list):
+        return tag, str(value)
+    if len(fields) == len(value):
+        return tag, '[' + ','.join('%s=%s' % (f, v)
+                                   for f, v in zip(fields, value)) + ']'
+    return tag, '[' + ','.join(str(v) for v in value) + ']'
+
+def _isRelevant(entry):
+    # only Fennec entries and crash entries about the debugged program
+    text = (entry.tag + ',' + entry.text).lower()
+    return 'gecko' in text or 'fennec' in text or _isRelevantCrash(entry)
+
+def _isRelevantCrash(entry):
+    if entry.buffer != 'crash':
+        return False
+    pkg = getattr(feninit.default, 'pkg', None)
+    return (pkg and pkg.partition(':')[0] in entry.text) or \
+            entry.pid == getattr(feninit.default, 'pid', None)
+
+def _formatCrash(entry):
+    return 'adb| \x1B[1;31m' + entry.tag + ': ' + entry.text + '\x1B[0m\n'
+
+def _isFollowed(pid):
+    # whether pid is the debugged process or one of its children
+    if not hasattr(feninit.default, 'pid'):
+        return True
+    if not log_procs:
+        return pid == feninit.default.pid
+    return pid in log_procs.followedPids(feninit.default.pid,
+                                         getattr(feninit.default, 'pkg', None))
 
 def default_filter(entry):
     global log_width, log_colorfn
-    if not hasattr(feninit.default, 'pid') or \
-            entry.pid == feninit.default.pid:
+    if _isFollowed(entry.pid):
         text = entry.text
         if log_width > 8 and len(text) + 5 > log_width:
             text = text[0: log_width - 8] + '...'
@@ -29,78 +123,318 @@ def _getColorFn(color):
         return PRIORITY_MAP[entry.priority] \
                 if entry.priority in PRIORITY_MAP else 5
     def threadColorFn(entry):
+        if entry.thread:
+            # same color for the same thread name across runs
+            return hash(entry.thread) % 5 + 2
         return (int(entry.tid, 0) % 5 + 2) if entry.tid else 5
     return priorityColorFn if color == 'priority' else \
             threadColorFn if color == 'thread' else orderColorFn
 
 log_colorfn = None
 log_filter = default_filter
+# pid/tid to name map of the current log reader; None if not reading
+log_procs = None
+
+class LogFilterStage(adbfilter.Stage):
+    '''Last pipeline stage, which formats entries using log_filter'''
+
+    def process(self, entries):
+        fn = log_filter
+        return [l for l in (fn(e) for e in entries) if l]
 
-class LogColor(gdb.Parameter):
-    '''Set 'adb logcat' output coloring'''
-    set_doc = 'Set "adb logcat" output color to be based on ' + \
-            '"order", "priority", or "thread"'
-    show_doc = 'Show current "adb logcat" output color scheme'
+# stages added here run on batches of entries before log_filter
+log_pipeline = adbfilter.Pipeline()
+log_output = LogFilterStage('log_filter')
+
+# parameters are defined in adbparams, so they exist before adblog is used
+log_color = adbparams.log_color
+log_redirect = adbparams.log_redirect
+log_rate_limit = adbparams.log_rate_limit
+
+class LogStats(object):
+    '''Counters for "adb logcat" redirection'''
 
     def __init__(self):
-        super(LogColor, self).__init__('adb-log-color',
-                gdb.COMMAND_SUPPORT, gdb.PARAM_ENUM,
-                ['order', 'priority', 'thread'])
-        self.value = 'order'
-        self.get_set_string()
+        self.reset()
+
+    def reset(self):
+        self.received = 0
+        self.filtered = 0
+        self.printed = 0
+        self.dropped = 0
+        self.flushes = 0
 
-    def get_set_string(self):
-        self.value = self.value.lower()
-        return 'Color "adb logcat" output based on ' + self.value
+    def __str__(self):
+        return '\n'.join([
+            'Entries received:         %d' % self.received,
+            'Entries filtered out:     %d' % self.filtered,
+            'Entries printed:          %d' % self.printed,
+            'Entries dropped by limit: %d' % self.dropped,
+            'Terminal writes:          %d' % self.flushes])
 
-    def get_show_string(self, svalue):
-        return 'Currently coloring "adb logcat" output based on ' + svalue
+log_stats = LogStats()
 
-class LogRedirect(gdb.Parameter):
-    '''Set whether to redirect 'adb logcat' to gdb when program is running'''
-    set_doc = 'Enable or disable redirecting "adb logcat"'
-    show_doc = 'Show current "adb logcat" redirection setting'
+class ShowLogStats(gdb.Command):
+    '''Show "adb logcat" redirection counters'''
 
     def __init__(self):
-        super(LogRedirect, self).__init__('adb-log-redirect',
-                gdb.COMMAND_SUPPORT, gdb.PARAM_BOOLEAN)
-        self.value = True
-        self.get_set_string()
+        super(ShowLogStats, self).__init__('show adb-log-stats',
+                gdb.COMMAND_SUPPORT)
+
+    def complete(self, text, word):
+        return gdb.COMPLETE_NONE
+
+    def invoke(self, argument, from_tty):
+        self.dont_repeat()
+        if argument.strip() == 'reset':
+            log_stats.reset()
+            log_pipeline.reset()
+            log_output.reset()
+            return
+        print str(log_stats)
+        print 'Filter stages:'
+        if log_pipeline.stages:
+            print str(log_pipeline)
+        print str(log_output)
+
+show_log_stats = ShowLogStats()
+
+def interrupt():
+    '''Interrupt the running program; safe to call from any thread'''
+    # same as pressing Ctrl+C in the gdb terminal
+    os.kill(os.getpid(), signal.SIGINT)
+
+class LogTriggers(object):
+    '''Patterns that interrupt the program when matched by a log entry'''
+
+    def __init__(self):
+        self.patterns = []
+        # (combined regex, {group name: pattern}, [(regex, pattern)]),
+        # replaced atomically so the reader thread never sees a partially
+        # updated matcher
+        self._matcher = None
+
+    def _isSimple(self, pattern):
+        # patterns without backreferences, named groups, or inline flags
+        # keep their meaning when combined into one alternation
+        parsed = sre_parse.parse(pattern)
+        if parsed.pattern.groupdict or parsed.pattern.flags:
+            return False
+        def hasGroupRef(av):
+            if isinstance(av, sre_parse.SubPattern):
+                return any(op in ('groupref', 'groupref_exists') or
+                           hasGroupRef(arg) for op, arg in av)
+            if isinstance(av, (tuple, list)):
+                return any(hasGroupRef(arg) for arg in av)
+            return False
+        return not hasGroupRef(parsed)
+
+    def _compile(self, patterns):
+        if not patterns:
+            return None
+        simple = [p for p in patterns if self._isSimple(p)]
+        # each combined pattern gets a named group, so the match tells
+        # which one matched; other patterns are matched on their own
+        names = dict(('p%d' % i, p) for i, p in enumerate(simple))
+        combined = re.compile('|'.join('(?P<p%d>%s)' % (i, p)
+                              for i, p in enumerate(simple))) \
+                   if simple else None
+        separate = [(re.compile(p), p) for p in patterns
+                    if p not in simple]
+        return (combined, names, separate)
+
+    def add(self, patterns):
+        patterns = self.patterns + [p for p in patterns
+                                    if p not in self.patterns]
+        try:
+            self._matcher = self._compile(patterns)
+        except (re.error, sre_parse.error) as e:
+            raise gdb.GdbError('invalid pattern: ' + str(e))
+        self.patterns = patterns
+
+    def remove(self, indices=None):
+        patterns = [] if indices is None else \
+                [self.patterns[i] for i in range(len(self.patterns))
+                 if i not in indices]
+        self._matcher = self._compile(patterns)
+        self.patterns = patterns
+
+    def match(self, entry):
+        # returns a matching pattern or None
+        matcher = self._matcher
+        if not matcher:
+            return None
+        combined, names, separate = matcher
+        line = entry.tag + ': ' + entry.text
+        if combined:
+            m = combined.search(line)
+            if m:
+                return names[m.lastgroup]
+        return next((p for r, p in separate if r.search(line)), None)
+
+log_triggers = LogTriggers()
+
+class ADBLogCommand(gdb.Command):
+    '''Commands for "adb logcat" redirection'''
+
+    def __init__(self):
+        super(ADBLogCommand, self).__init__('adb-log',
+                gdb.COMMAND_SUPPORT, gdb.COMPLETE_NONE, True)
+
+    def invoke(self, argument, from_tty):
+        gdb.execute('help adb-log', from_tty)
+
+class ADBLogBreak(gdb.Command):
+    '''Interrupt the program when a log entry matches a pattern
+
+    Usage: adb-log break [REGEX]...
+
+Each REGEX is matched against "TAG: TEXT" of every log entry while the
+program is running. Without arguments, list the active patterns.'''
+
+    def __init__(self):
+        super(ADBLogBreak, self).__init__('adb-log break',
+                gdb.COMMAND_BREAKPOINTS)
+
+    def complete(self, text, word):
+        return gdb.COMPLETE_NONE
 
-    def get_set_string(self):
-        return 'Set to ' + ('' if self.value else 'not ') + \
-                'redirect "adb logcat" output'
+    def invoke(self, argument, from_tty):
+        self.dont_repeat()
+        patterns = gdb.string_to_argv(argument)
+        if patterns:
+            log_triggers.add(patterns)
+        if not log_triggers.patterns:
+            print 'No log patterns.'
+            return
+        for i in range(len(log_triggers.patterns)):
+            print '%d. %s' % (i + 1, log_triggers.patterns[i])
 
-    def get_show_string(self, svalue):
-        return 'Currently ' + ('' if self.value else 'not ') + \
-                'redirecting "adb logcat" output'
+class ADBLogDelete(gdb.Command):
+    '''Delete patterns set by "adb-log break"
 
-log_color = LogColor()
-log_redirect = LogRedirect()
+    Usage: adb-log delete [NUMBER]...
+
+Without arguments, delete all patterns.'''
+
+    def __init__(self):
+        super(ADBLogDelete, self).__init__('adb-log delete',
+                gdb.COMMAND_BREAKPOINTS)
+
+    def complete(self, text, word):
+        return gdb.COMPLETE_NONE
+
+    def invoke(self, argument, from_tty):
+        self.dont_repeat()
+        args = gdb.string_to_argv(argument)
+        if not args:
+            log_triggers.remove()
+            return
+        if not all(a.isdigit() and 0 < int(a) <= len(log_triggers.patterns)
+                   for a in args):
+            raise gdb.GdbError('invalid pattern number')
+        log_triggers.remove([int(a) - 1 for a in args])
+
+adblog_command = ADBLogCommand()
+adblog_break = ADBLogBreak()
+adblog_delete = ADBLogDelete()
+
+class LogWriter(threading.Thread):
+    '''Coalesce log output and write it to the terminal in batches'''
+
+    # seconds between writes to the terminal
+    FLUSH_INTERVAL = 0.05
+    # bytes of pending output that triggers an early write
+    FLUSH_SIZE = 16384
+
+    def __init__(self, out, stats=None, name='ADBLogWriter'):
+        super(LogWriter, self).__init__(name=name)
+        self.daemon = True
+        self.out = out
+        # counters for "show adb-log-stats", unless given other counters
+        self.stats = stats or log_stats
+        self.rateLimit = 0
+        self.running = True
+        self._cond = threading.Condition()
+        # keeps batches in order when flushing from multiple threads
+        self._outLock = threading.Lock()
+        self._pending = []
+        self._pendingSize = 0
+        self._window = 0
+        self._windowCount = 0
+        self._suppressed = 0
+
+    def _checkWindow(self, now):
+        # called with self._cond held
+        window = int(now)
+        if window == self._window:
+            return
+        self._window = window
+        self._windowCount = 0
+        if self._suppressed:
+            self._append('adb| \x1B[1m%d entries suppressed\x1B[22m\n' %
+                         self._suppressed)
+            self._suppressed = 0
+
+    def _append(self, text):
+        self._pending.append(text)
+        self._pendingSize += len(text)
+
+    def write(self, text, limited=True):
+        self.writeAll([text], limited)
+
+    def writeAll(self, texts, limited=True):
+        with self._cond:
+            self._checkWindow(time.time())
+            for text in texts:
+                if limited and self.rateLimit and \
+                        self._windowCount >= self.rateLimit:
+                    self._suppressed += 1
+                    self.stats.dropped += 1
+                    continue
+                self._windowCount += 1
+                self.stats.printed += 1
+                self._append(text)
+            if self._pendingSize >= self.FLUSH_SIZE:
+                self._cond.notify()
+
+    def flush(self):
+        with self._outLock:
+            with self._cond:
+                self._checkWindow(time.time())
+                if not self._pending:
+                    return
+                out = ''.join(self._pending)
+                self._pending = []
+                self._pendingSize = 0
+                self.stats.flushes += 1
+            self.out.write(out)
+            self.out.flush()
+
+    def run(self):
+        while self.running:
+            with self._cond:
+                self._cond.wait(self.FLUSH_INTERVAL)
+            self.flush()
+
+    def terminate(self):
+        self.running = False
+        with self._cond:
+            self._cond.notify()
 
 class ADBLog(threading.Thread):
 
-    def _parseLog(self, logFile):
-        wholeLog = ''
-        while 'gecko' not in wholeLog and 'fennec' not in wholeLog:
-            line = ''
-            while not line.startswith('['):
-                line = logFile.readline()
-                if not line:
-                    raise StopIteration()
-            # line == '[ DAY TIME PID:TID PRIO/TAG ]'
-            items = line.strip('[] \t\r\n').split()
-            text = []
-            while True:
-                line = logFile.readline()
-                if not line:
-                    raise StopIteration()
-                line = line.strip()
-                if not line:
-                    break
-                text.append(line)
-            wholeLog = ' '.join(items).lower() + ',' + ' '.join(text).lower()
+    # bytes to read from logcat at a time
+    READ_SIZE = 65536
+
+    # size of struct logger_entry (v1), which has no hdr_size field
+    LOGGER_ENTRY_V1_SIZE = 20
 
+    def _parseEntry(self, header, text):
+        # header == '[ DAY TIME PID:TID PRIO/TAG ]'
+        items = header.strip('[] \t\r\n').split()
+        if len(items) < 4:
+            return None
         if len(items) < 5:
             pidtid = items[2].partition(':')
             priotag = items[3].partition('/')
@@ -109,49 +443,162 @@ class ADBLog(threading.Thread):
             priotag = items[4].partition('/')
         return ADBLogEntry(items[0], items[1],
                 pidtid[0], pidtid[2],
-                priotag[0], priotag[2], '\\\\'.join(text));
+                priotag[0], priotag[2], '\\\\'.join(text), None,
+                self.procs.processName(pidtid[0]),
+                self.procs.threadName(pidtid[2]));
+
+    def _parseBinary(self, data):
+        # returns (list of complete entries, remaining unparsed data)
+        entries = []
+        pos = 0
+        while len(data) - pos >= 4:
+            # struct logger_entry, see android/log.h
+            size, hdrSize = struct.unpack_from('<HH', data, pos)
+            hdrSize = hdrSize or self.LOGGER_ENTRY_V1_SIZE
+            end = pos + hdrSize + size
+            if end > len(data):
+                break
+            pid, tid, sec, nsec = struct.unpack_from('<iiii', data, pos + 4)
+            lid = struct.unpack_from('<I', data, pos + 20)[0] \
+                  if hdrSize >= 24 else 0
+            buf = LOG_BUFFER_IDS[lid] if lid < len(LOG_BUFFER_IDS) else ''
+            payload = data[pos + hdrSize: end]
+            pos = end
+            if buf == 'events':
+                prio = 'I'
+                tag, text = _formatEvent(payload, self.eventTags)
+            else:
+                if not payload:
+                    continue
+                prio = ord(payload[0])
+                prio = LOG_PRIORITIES[prio] \
+                       if prio < len(LOG_PRIORITIES) else '?'
+                tag, sep, text = payload[1:].partition('\0')
+                text = text.rstrip('\0\n').replace('\n', '\\\\')
+            ts = time.localtime(sec)
+            pid = str(pid)
+            tid = str(tid)
+            entries.append(ADBLogEntry(time.strftime('%m-%d', ts),
+                    time.strftime('%H:%M:%S', ts) + '.%03d' % (nsec / 1000000),
+                    pid, tid, prio, tag, text, buf,
+                    self.procs.processName(pid), self.procs.threadName(tid)))
+        return entries, data[pos:]
+
+    def _parseLog(self, data):
+        # returns (list of complete entries, remaining unparsed data)
+        entries = []
+        lines = data.split('\n')
+        # the last line is incomplete
+        end = len(lines) - 1
+        header = None
+        for i in xrange(end):
+            if header is None:
+                if lines[i].startswith('['):
+                    header = i
+                continue
+            if lines[i].strip():
+                continue
+            entry = self._parseEntry(lines[header],
+                    [l.strip() for l in lines[header + 1: i]])
+            if entry:
+                entries.append(entry)
+            header = None
+        return entries, '\n'.join(lines[end if header is None else header:])
 
     def __init__(self):
         super(ADBLog, self).__init__(name='ADBLog')
         self.daemon = True
 
-        logcatArgs = ['-v', 'long']
+        global log_procs
+        self.procs = log_procs = procmap.ProcMap()
 
-        logCount = 0
-        dump = cStringIO.StringIO(adb.call(['logcat', '-d'] + logcatArgs))
-        try:
-            while True: # parse until the end of log
-                self._parseLog(dump)
-                logCount += 1
-        except StopIteration:
-            pass
-        self.skipCount = logCount
+        # binary output carries the buffer of each entry; it needs
+        # 'adb exec-out' to not be mangled, which requires Android 5.0
+        self.binary = adb.getSdkVersion() >= 21
+        if self.binary:
+            self.eventTags = _getEventTags()
+            self.parse = self._parseBinary
+            logcatCmd = ['exec-out', 'logcat', '-B']
+            for buf in LOG_BUFFERS:
+                logcatCmd.extend(['-b', buf])
+        else:
+            self.parse = self._parseLog
+            logcatCmd = ['logcat', '-v', 'long']
+
+        # parse until the end of log; adb warnings on stderr would
+        # corrupt the binary stream, so keep them out of stdout
+        dump = adb.call(logcatCmd + ['-d'], stderr=subprocess.PIPE)
+        self.skipCount = len(self.parse(
+                dump if self.binary else dump + '\n\n')[0])
 
         def adblogPreExec():
             os.setpgrp()
-        self.logcat = adb.call(['logcat'] + logcatArgs,
-                stdin=None, async=True, preexec_fn=adblogPreExec)
+        with open(os.devnull, 'w') as devnull:
+            self.logcat = adb.call(logcatCmd, stdin=None, stderr=devnull,
+                    async=True, preexec_fn=adblogPreExec)
 
         self.running = False
+        self.redirect = True
+        self.triggered = False
+        self.writer = LogWriter(sys.__stderr__)
 
     def run(self):
-        try:
-            global log_filter
-            while self.logcat.poll() == None:
-                entry = self._parseLog(self.logcat.stdout)
-                if self.skipCount:
-                    self.skipCount -= 1
-                    continue
-                if not self.running:
-                    continue
-                log = log_filter(entry)
-                if not log:
-                    continue
-                sys.__stderr__.write(log)
-        except StopIteration:
-            pass
+        self.writer.start()
+        self.procs.start()
+        fd = self.logcat.stdout.fileno()
+        data = ''
+        while True:
+            try:
+                # returns whatever is available, so a batch
+                # is everything logged since the last read
+                chunk = os.read(fd, self.READ_SIZE)
+            except OSError:
+                break
+            if not chunk:
+                break
+            batch, data = self.parse(data + chunk)
+            if self.skipCount:
+                skip = min(self.skipCount, len(batch))
+                self.skipCount -= skip
+                batch = batch[skip:]
+            if not batch or not self.running:
+                continue
+            batch = [e for e in batch if _isRelevant(e)]
+            if batch:
+                self._process(batch)
+
+    def _process(self, batch):
+        if self.binary:
+            # always show crashes regardless of filters, if redirecting
+            crashes = [_formatCrash(e) for e in batch if _isRelevantCrash(e)]
+            if crashes:
+                if self.redirect:
+                    self.writer.writeAll(crashes, limited=False)
+                batch = [e for e in batch if not _isRelevantCrash(e)]
+        log_stats.received += len(batch)
+        if not self.triggered:
+            for entry in batch:
+                pattern = log_triggers.match(entry)
+                if pattern:
+                    self._trigger(entry, pattern)
+                    break
+        if not self.redirect:
+            return
+        logs = log_output.run(log_pipeline.run(batch))
+        log_stats.filtered += len(batch) - len(logs)
+        self.writer.writeAll(logs)
+
+    def _trigger(self, entry, pattern):
+        self.triggered = True
+        self.writer.write('adb| \x1B[1mlog matched "%s"; interrupting\n'
+                          'adb| %s: %s\x1B[22m\n' %
+                          (pattern, entry.tag, entry.text), limited=False)
+        self.writer.flush()
+        interrupt()
 
     def terminate(self):
+        self.writer.terminate()
+        self.procs.terminate()
         self.logcat.terminate();
 
 def cont_handler(event):
@@ -159,7 +606,8 @@ def cont_handler(event):
         return
     global continuing
     continuing = True
-    if not bool(gdb.parameter('adb-log-redirect')):
+    redirect = bool(gdb.parameter('adb-log-redirect'))
+    if not redirect and not log_triggers.patterns:
         exit_handler(event)
         continuing = True
         return
@@ -170,6 +618,10 @@ def cont_handler(event):
         adblog.start()
     log_width = int(gdb.parameter('width'))
     log_colorfn = _getColorFn(str(gdb.parameter('adb-log-color')))
+    adblog.writer.rateLimit = int(gdb.parameter('adb-log-rate-limit') or 0)
+    adblog.redirect = redirect
+    adblog.triggered = False
+    adblog.procs.active = True
     adblog.running = True
 
 def stop_handler(event):
@@ -179,6 +631,9 @@ def stop_handler(event):
     if not adblog:
         return
     adblog.running = False
+    adblog.procs.active = False
+    # show pending output before the prompt
+    adblog.writer.flush()
 
 def exit_handler(event):
     global continuing
@@ -187,6 +642,7 @@ def exit_handler(event):
     if not adblog:
         return
     adblog.running = False
+    adblog.writer.flush()
     adblog.terminate()
     adblog = None
 
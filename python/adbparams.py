@@ -3,7 +3,11 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import gdb
+import gdb, adb
+
+def _commandChanged():
+    # other threads cannot read parameters, so save the command line now
+    adb.setCommand(path.value, device.value)
 
 class ADBPath(gdb.Parameter):
     '''When set, use the specified path when launching ADB instead of "adb"'''
@@ -13,11 +17,11 @@ class ADBPath(gdb.Parameter):
     def __init__(self):
         super(ADBPath, self).__init__('adb-path',
                 gdb.COMMAND_SUPPORT, gdb.PARAM_OPTIONAL_FILENAME)
-        self.value = None
-        self.get_set_string()
+        self.value = 'adb'
 
     def get_set_string(self):
         self.value = self.value.strip() if self.value else 'adb'
+        _commandChanged()
         return 'New Android ADB tool is "' + self.value + '"'
 
     def get_show_string(self, svalue):
@@ -37,6 +41,7 @@ class ADBDevice(gdb.Parameter):
 
     def get_set_string(self):
         self.value = self.value if self.value else ''
+        _commandChanged()
         return 'New ADB device is "' + self.value + '"'
 
     def get_show_string(self, svalue):
@@ -44,3 +49,68 @@ class ADBDevice(gdb.Parameter):
 
 device = ADBDevice()
 
+class LogColor(gdb.Parameter):
+    '''Set 'adb logcat' output coloring'''
+    set_doc = 'Set "adb logcat" output color to be based on ' + \
+            '"order", "priority", or "thread"'
+    show_doc = 'Show current "adb logcat" output color scheme'
+
+    def __init__(self):
+        super(LogColor, self).__init__('adb-log-color',
+                gdb.COMMAND_SUPPORT, gdb.PARAM_ENUM,
+                ['order', 'priority', 'thread'])
+        self.value = 'order'
+        self.get_set_string()
+
+    def get_set_string(self):
+        self.value = self.value.lower()
+        return 'Color "adb logcat" output based on ' + self.value
+
+    def get_show_string(self, svalue):
+        return 'Currently coloring "adb logcat" output based on ' + svalue
+
+class LogRedirect(gdb.Parameter):
+    '''Set whether to redirect 'adb logcat' to gdb when program is running'''
+    set_doc = 'Enable or disable redirecting "adb logcat"'
+    show_doc = 'Show current "adb logcat" redirection setting'
+
+    def __init__(self):
+        super(LogRedirect, self).__init__('adb-log-redirect',
+                gdb.COMMAND_SUPPORT, gdb.PARAM_BOOLEAN)
+        self.value = True
+        self.get_set_string()
+
+    def get_set_string(self):
+        return 'Set to ' + ('' if self.value else 'not ') + \
+                'redirect "adb logcat" output'
+
+    def get_show_string(self, svalue):
+        return 'Currently ' + ('' if self.value else 'not ') + \
+                'redirecting "adb logcat" output'
+
+class LogRateLimit(gdb.Parameter):
+    '''Set maximum number of 'adb logcat' entries printed per second'''
+    set_doc = 'Set maximum number of "adb logcat" entries printed ' + \
+            'per second; 0 means unlimited'
+    show_doc = 'Show current "adb logcat" rate limit'
+
+    def __init__(self):
+        super(LogRateLimit, self).__init__('adb-log-rate-limit',
+                gdb.COMMAND_SUPPORT, gdb.PARAM_UINTEGER)
+        self.value = 0
+        self.get_set_string()
+
+    def get_set_string(self):
+        return ('Printing at most %d "adb logcat" entries per second' %
+                self.value) if self.value else \
+                'Printing all "adb logcat" entries'
+
+    def get_show_string(self, svalue):
+        return 'Currently printing ' + \
+                ('at most ' + svalue if self.value else 'all') + \
+                ' "adb logcat" entries' + \
+                (' per second' if self.value else '')
+
+log_color = LogColor()
+log_redirect = LogRedirect()
+log_rate_limit = LogRateLimit()
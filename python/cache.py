@@ -0,0 +1,45 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gdb, os, json, hashlib, tempfile, threading
+
+# cache files live next to the pulled libraries ('lib') and XRE ('xre')
+root = os.path.abspath(os.path.join(
+        str(gdb.parameter('data-directory')), os.pardir, 'cache'))
+
+_lock = threading.Lock()
+
+def key(*parts):
+    '''Return a file name safe key for the given strings'''
+    return hashlib.sha1('\0'.join(str(p) for p in parts)).hexdigest()
+
+def path(*names):
+    '''Return path under the cache directory, creating parent directories'''
+    p = os.path.join(root, *names)
+    try:
+        os.makedirs(os.path.dirname(p))
+    except OSError:
+        pass
+    return p
+
+def load(name, default=None):
+    '''Load JSON data saved under name, or return default'''
+    try:
+        with open(path(name + '.json'), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+def save(name, data):
+    '''Save data as JSON under name; safe to call from any thread'''
+    dst = path(name + '.json')
+    with _lock:
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, dst)
+        except (IOError, OSError):
+            pass
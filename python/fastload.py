@@ -3,7 +3,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import gdb, threading, os, sys, subprocess, feninit, adb
+import gdb, threading, os, sys, subprocess, feninit, adb, lazy
 
 class FastLoad(gdb.Command):
     '''Pull libraries in background'''
@@ -17,29 +17,19 @@ class FastLoad(gdb.Command):
 
     def invoke(self, argument, from_tty):
         if self._loader:
-            print 'Already running.'
-            return
+            if self._loader.isAlive():
+                print 'Already running.'
+                return
+            # finished before the program stopped
+            self.exit_handler(None)
         libdir = feninit.default.libdir \
                 if hasattr(feninit.default, 'libdir') else None
         if not libdir:
             return
-        force = True
-        idfile = os.path.join(libdir, '.id')
-        devid = adb.call(['shell', 'cat', '/proc/version',
-                          '/system/build.prop'])[0:2048].strip()
-        try:
-            with open(idfile, 'r') as libid:
-                if libid.read(2048) == devid:
-                    force = False
-                    if argument == 'quick':
-                        return
-        except IOError:
-            pass
         self._loader = FastLoad.Loader()
         self._loader.solibs = gdb.execute('info sharedlibrary', False, True)
-        self._loader.force = force
-        self._loader.idfile = idfile
-        self._loader.devid = devid
+        self._loader.quick = argument == 'quick'
+        self._loader.idfile = os.path.join(libdir, '.id')
         gdb.events.cont.connect(self.cont_handler)
         gdb.events.stop.connect(self.stop_handler)
         gdb.events.exited.connect(self.exit_handler)
@@ -83,6 +73,23 @@ class FastLoad(gdb.Command):
         def run(self):
             PARALLEL_LIMIT = 5
 
+            self.hasLibs = False
+            # check the device in this thread, so startup is not blocked
+            try:
+                self.devid = adb.call(['shell', 'cat', '/proc/version',
+                        '/system/build.prop'])[0:2048].strip()
+            except gdb.GdbError:
+                return
+            self.force = True
+            try:
+                with open(self.idfile, 'r') as libid:
+                    if libid.read(2048) == self.devid:
+                        self.force = False
+                        if self.quick:
+                            return
+            except IOError:
+                pass
+
             libdir = feninit.default.libdir
             objdir = feninit.default.objdir \
                     if hasattr(feninit.default, 'objdir') else None
@@ -167,5 +174,8 @@ class FastLoad(gdb.Command):
                         'All libraries pulled from device. Continuing.\n')
 
 default = FastLoad()
-feninit.default.skipPull = True
+lazy.bind(__name__, default)
+# fastload pulls libraries instead of feninit, unless set in gdbinit.local
+if not hasattr(feninit.default, 'skipPull'):
+    feninit.default.skipPull = True
 
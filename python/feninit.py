@@ -3,8 +3,57 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import gdb, adb, readinput, adblog, getxre
-import os, sys, subprocess, threading, time, shlex, tempfile, pipes, shutil, re
+import gdb, adb, readinput, adblog, getxre, cache, procwatch, mochitest, lazy
+from phases import PhaseGraph
+from multiprocessing.pool import ThreadPool
+import os, sys, subprocess, threading, time, shlex, pipes, shutil, re
+import json, glob, collections, hashlib
+
+class DeviceSession(object):
+    '''FenInit state that belongs to one device
+
+    Switching devices saves the active device's state in its session and
+    restores the other one, without talking to either device.'''
+
+    # FenInit attributes that describe the device being debugged
+    ATTRS = ('device', 'libdir', 'pkg', 'pid', 'port', 'gdbserver',
+             'gdbservers', 'inferiors', '_appProcessName')
+
+    def __init__(self, device):
+        self.device = device
+        self.state = {'device': device}
+        self.sysroot = None
+        self.solibSearchPath = None
+        self.inferior = None
+        # summary from 'feninit prepare', if the device was prepared
+        self.prepared = None
+
+    def connected(self):
+        gdbserver = self.state.get('gdbserver')
+        return bool(gdbserver) and gdbserver.poll() is None
+
+    def save(self, obj):
+        self.state = dict((attr, getattr(obj, attr)) for attr in self.ATTRS
+                          if hasattr(obj, attr))
+        self.state['device'] = self.device
+        self.sysroot = str(gdb.parameter('sysroot'))
+        self.solibSearchPath = str(gdb.parameter('solib-search-path'))
+        self.inferior = gdb.selected_inferior().num
+
+    def restore(self, obj):
+        for attr in self.ATTRS:
+            if attr in self.state:
+                setattr(obj, attr, self.state[attr])
+            elif hasattr(obj, attr):
+                delattr(obj, attr)
+        if self.sysroot is not None:
+            gdb.execute('set sysroot ' + self.sysroot, False, True)
+        if self.solibSearchPath is not None:
+            gdb.execute('set solib-search-path ' + self.solibSearchPath,
+                        False, True)
+        if self.inferior and self.inferior != gdb.selected_inferior().num \
+                and any(inf.num == self.inferior for inf in gdb.inferiors()):
+            gdb.execute('inferior %d' % self.inferior, False, True)
 
 class FenInit(gdb.Command):
     '''Initialize gdb for debugging Fennec on Android'''
@@ -16,7 +65,10 @@ class FenInit(gdb.Command):
         'Debug content Mochitest',
         'Debug compiled-code unit test',
         'Debug Fennec with pid',
-        'Debug another package'
+        'Debug another package',
+        'Run compiled-code unit tests in batch',
+        # only offered if a warm session was saved
+        'Reattach to the last session',
     )
     (
         TASK_FENNEC,
@@ -26,13 +78,163 @@ class FenInit(gdb.Command):
         TASK_CPP_TEST,
         TASK_ATTACH_PID,
         TASK_ATTACH_PACKAGE,
+        TASK_CPP_BATCH,
+        TASK_REATTACH,
     ) = tuple(range(len(TASKS)))
 
+    # libraries/binaries to pull from device
+    DEFAULT_LIBS = ['system/lib/libdl.so', 'system/lib/libc.so',
+            'system/lib/libm.so', 'system/lib/libstdc++.so',
+            'system/lib/liblog.so', 'system/lib/libz.so',
+            'system/lib/libGLESv2.so', 'system/bin/linker']
+    # search path for above libraries/binaries
+    DEFAULT_SEARCH_PATHS = [['system', 'lib'],
+                            ['system', 'vendor', 'lib'],
+                            ['system', 'bin']]
+
     def __init__(self):
         super(FenInit, self).__init__('feninit', gdb.COMMAND_SUPPORT)
+        # DeviceSession by device serial
+        self.sessions = {}
 
     def complete(self, text, word):
-        return gdb.COMPLETE_NONE
+        if text.split()[:1] == ['switch'] and \
+                (len(text.split()) > 1 or text.endswith(' ')):
+            return [d for d in sorted(self.sessions) if d.startswith(word)]
+        if text.strip() != word.strip():
+            return gdb.COMPLETE_NONE
+        return [c for c in ['reattach', 'prepare', 'switch']
+                if c.startswith(word)]
+
+    def _session(self, dev):
+        if dev not in self.sessions:
+            self.sessions[dev] = DeviceSession(dev)
+        return self.sessions[dev]
+
+    def _prepare(self, devs):
+        # prepare several devices at once, so switching to one of them
+        # later does not need any device round trips
+        connected = adb.getDevices()
+        devs = devs or connected
+        missing = [d for d in devs if d not in connected]
+        if missing:
+            raise gdb.GdbError('Not connected: ' + ', '.join(missing))
+        self.bindir = os.path.abspath(os.path.join(
+                str(gdb.parameter('data-directory')), os.pardir, 'bin'))
+        self._chooseObjdir()
+        objdir = self.objdir
+        pkg = self._getPackageName(objdir) if objdir else None
+        apk = self._findApk(objdir) if objdir else None
+
+        # gdb parameters can only be read on the main thread
+        libdirs = dict((dev, self._deviceLibDir(dev)) for dev in devs)
+
+        print 'Preparing %s...' % ', '.join(devs)
+        results = {}
+        def prepare(dev):
+            adb.useDevice(dev)
+            try:
+                results[dev] = self._prepareDevice(
+                        dev, pkg, apk, libdirs[dev])
+            except Exception, e:
+                results[dev] = 'failed: ' + str(e)
+            finally:
+                adb.useDevice(None)
+        threads = [threading.Thread(name='Prepare', target=prepare,
+                                    args=(dev,)) for dev in devs]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                # wake up periodically, so Ctrl+C works
+                thread.join(0.1)
+
+        for dev in devs:
+            result = results.get(dev)
+            if isinstance(result, basestring):
+                print '  %s: %s' % (dev, result)
+                continue
+            session = self._session(dev)
+            if not session.connected():
+                libdir = libdirs[dev]
+                session.state.update({'libdir': libdir, 'pkg': pkg,
+                        '_appProcessName': result['appProcess']})
+                session.sysroot = libdir
+                session.solibSearchPath = self._searchPaths(libdir, objdir)
+            session.prepared = result
+            print '  %s: apk %s, %d libraries not pulled' % (
+                    dev, result['apk'], len(result['missingLibs']))
+        print 'Use "feninit switch SERIAL" to choose a device.'
+
+    def _prepareDevice(self, dev, pkg, apk, libdir):
+        # runs on a worker thread with adb.useDevice(dev); pulls libraries
+        # into libdir, installs the apk if needed, and pushes gdbserver
+        result = {
+            'appProcess': self._pullAppProcess(libdir),
+            'missingLibs': self._pullSystemLibs(libdir),
+            'apk': 'not checked',
+        }
+        if pkg and apk:
+            pkg = pkg.partition(':')[0]
+            devapk = self._getDevicePackages() or {}
+            devapk = devapk.get(pkg)
+            match = False
+            if devapk:
+                devapkls = adb.call(['shell', 'ls', '-l', devapk]).strip()
+                # several devices are prepared at once, so only the
+                # summary reports the result
+                match = self._matchApk(pkg, apk, devapk, devapkls,
+                                       quiet=True)
+            if match is None or match:
+                result['apk'] = 'up to date'
+            elif 'success' in self._installApk(apk).lower():
+                self._saveVerifiedApk(pkg, apk)
+                result['apk'] = 'installed'
+            else:
+                result['apk'] = 'install failed'
+        self._pushGDBServer()
+        return result
+
+    def _switch(self, dev):
+        # make dev the active device, using the state saved in its session
+        if dev not in self.sessions:
+            raise gdb.GdbError('No session for %s; use "feninit prepare %s" '
+                               'or run feninit on it first.' % (dev, dev))
+        current = getattr(self, 'device', None)
+        if current == dev:
+            print 'Already using device %s.' % dev
+            return
+        if current:
+            self._session(current).save(self)
+        self.sessions[dev].restore(self)
+        gdb.execute('set adb-device ' + dev, False, True)
+        session = self.sessions[dev]
+        print 'Using device %s%s.' % (dev,
+                ' (%s, pid %s)' % (session.state.get('pkg'),
+                                   session.state.get('pid'))
+                if session.connected() else '')
+
+    def _newInferiorIfBusy(self):
+        # keep other devices' connections; debug this one in a new inferior
+        session = self.sessions.get(self.device)
+        if session and session.connected():
+            # e.g. adb-device was changed after switching away from it
+            raise gdb.GdbError('Device %s is already being debugged; use '
+                               '"feninit switch %s".' % ((self.device,) * 2))
+        busy = [d for d, s in self.sessions.iteritems()
+                if d != self.device and s.connected()]
+        if not busy:
+            return
+        if not self._supportsMultiTarget(quiet=True):
+            # a new connection would replace the busy device's connection
+            raise gdb.GdbError('Already debugging on %s; debugging several '
+                    'devices at once requires GDB 10 or later. Switch to '
+                    'the device with "feninit switch" and detach first.' %
+                    ', '.join(sorted(busy)))
+        gdb.execute('add-inferior -no-connection', False, True)
+        num = max(inf.num for inf in gdb.inferiors())
+        gdb.execute('inferior %d' % num, False, True)
 
     def _chooseTask(self):
         if ('SSH_CONNECTION' in os.environ and
@@ -52,14 +254,18 @@ class FenInit(gdb.Command):
                     print '* configure jdwp_port in gdbinit.local to set the ' \
                           'forwarding port for jdb debugging'
                 print '********'
+        # reattaching keeps the process from the last session alive,
+        # instead of launching or killing the app
+        tasks = self.TASKS if cache.load('sessions', {}) else \
+                self.TASKS[:self.TASK_REATTACH]
         print '\nFennec GDB utilities'
         print '  (see utils/gdbinit and utils/gdbinit.local on how to configure settings)'
-        for i in range(len(self.TASKS)):
-            print '%d. %s' % (i + 1, self.TASKS[i])
+        for i in range(len(tasks)):
+            print '%d. %s' % (i + 1, tasks[i])
         task = 0
-        while task < 1 or task > len(self.TASKS):
+        while task < 1 or task > len(tasks):
             task = readinput.call('Enter option from above: ', '-l',
-                                  str(list(self.TASKS)))
+                                  list(tasks))
             if not task:
                 task = 1
                 break
@@ -67,9 +273,9 @@ class FenInit(gdb.Command):
                 task = int(task)
                 continue
             matchTask = filter(lambda x: x.lower().startswith(task.lower()),
-                               self.TASKS)
+                               tasks)
             if len(matchTask) == 1:
-                task = self.TASKS.index(matchTask[0]) + 1
+                task = tasks.index(matchTask[0]) + 1
         print ''
         return task - 1
 
@@ -102,13 +308,20 @@ class FenInit(gdb.Command):
                     objdirs.insert(0, objdir)
 
         objdir = '' # None means don't use an objdir
-        objdirs = []
         # look for possible locations
-        srcroot = os.path.expanduser(os.path.expandvars(
-            self.srcroot if hasattr(self, 'srcroot') else '~'))
-        for d in os.listdir(srcroot):
-            scanSrcDir(objdirs, os.path.join(srcroot, d))
-        objdirs.sort()
+        srcroot = os.path.abspath(os.path.expanduser(os.path.expandvars(
+            self.srcroot if hasattr(self, 'srcroot') else '~')))
+        index = cache.load(self._objdirIndexName(srcroot))
+        if index:
+            # use the saved index now and update it for next time
+            refresh = threading.Thread(name='ObjdirIndex',
+                    target=self._indexObjdirs, args=(srcroot, index))
+            refresh.daemon = True
+            refresh.start()
+        else:
+            index = self._indexObjdirs(srcroot, None)
+        objdirs = sorted(set(o for e in index['entries'].itervalues()
+                             for o in e['objdirs'] if self._isObjDir(o)))
 
         # use saved setting if possible; also allows gdbinit to set objdir
         if hasattr(self, 'objdir'):
@@ -153,13 +366,118 @@ class FenInit(gdb.Command):
         print 'Using object directory: %s' % str(objdir)
         self.objdir = objdir
 
-    def _pullAppProcess(self):
+    def _setLibDirs(self):
+        datadir = str(gdb.parameter('data-directory'))
+        self.datadir = datadir
+        self.libdir = self._deviceLibDir(self.device)
+        self.bindir = os.path.abspath(
+                os.path.join(datadir, os.pardir, 'bin'))
+
+    def _deviceLibDir(self, dev):
+        return os.path.abspath(os.path.join(
+                str(gdb.parameter('data-directory')), os.pardir, 'lib', dev))
+
+    def _startPhases(self):
+        # start device round trips that do not need user input,
+        # so they overlap with the prompts on the main thread
+        phases = PhaseGraph()
+        phases.add('appProcess', self._pullAppProcess)
+        if hasattr(self, 'skipPull') and not self.skipPull:
+            phases.add('systemLibs', self._pullSystemLibs)
+        phases.add('gdbserver', self._pushGDBServer)
+        phases.add('devicePackages', self._getDevicePackages)
+        phases.add('deviceApks', lambda devpkgs: self._listDeviceApks(
+                [apk for pkg, apk in (devpkgs or {}).iteritems()
+                 if pkg.startswith('org.mozilla.')]),
+                deps=['devicePackages'])
+        if self._task in (self.TASK_FENNEC, self.TASK_JAVA):
+            phases.add('runningProcs', lambda: self._getRunningProcs(None))
+        self._phases = phases
+
+    def _stopPhases(self):
+        if hasattr(self, '_phases'):
+            self._phases.close()
+            delattr(self, '_phases')
+
+    def _prefetched(self, name, fn, *args):
+        # use the result of a phase started by _startPhases if there is
+        # one; otherwise, call fn now
+        phases = getattr(self, '_phases', None)
+        if phases and name in phases:
+            return phases.result(name)
+        return fn(*args)
+
+    def _invalidate(self, *names):
+        phases = getattr(self, '_phases', None)
+        for name in names:
+            if phases:
+                phases.forget(name)
+
+    def _objdirIndexName(self, srcroot):
+        return 'objdirs-' + cache.key(srcroot)
+
+    def _findObjdirs(self, path):
+        # returns (objdirs, candidates) where candidates are 'obj*' dirs
+        if self._isObjDir(path):
+            return [path], []
+        try:
+            candidates = [os.path.join(path, d) for d in os.listdir(path)
+                          if d.startswith('obj')]
+        except OSError:
+            return [], []
+        candidates = [c for c in candidates if os.path.isdir(c)]
+        return [c for c in candidates if self._isObjDir(c)], candidates
+
+    def _dirSignature(self, paths):
+        # mtimes change when entries are added to or removed from dirs
+        sig = []
+        for path in paths:
+            try:
+                sig.append(os.stat(path).st_mtime)
+            except OSError:
+                sig.append(None)
+        return sig
+
+    def _indexObjdirs(self, srcroot, index):
+        # index has the format {'mtime': srcroot mtime, 'entries': {dir:
+        #   {'sig': mtimes, 'candidates': obj* dirs, 'objdirs': objdirs}}};
+        # only dirs whose signature changed are scanned again
+        old = index['entries'] if index else {}
+        mtime = self._dirSignature([srcroot])[0]
+        if index and index['mtime'] == mtime:
+            paths = old.keys()
+        else:
+            try:
+                paths = [os.path.join(srcroot, d) for d in os.listdir(srcroot)]
+            except OSError:
+                paths = []
+        entries = {}
+        for path in paths:
+            entry = old.get(path)
+            if entry and entry['sig'] == self._dirSignature(
+                    [path] + entry['candidates']):
+                entries[path] = entry
+                continue
+            if not os.path.isdir(path):
+                continue
+            objdirs, candidates = self._findObjdirs(path)
+            entries[path] = {'sig': self._dirSignature([path] + candidates),
+                             'candidates': candidates, 'objdirs': objdirs}
+        index = {'mtime': mtime, 'entries': entries}
+        cache.save(self._objdirIndexName(srcroot), index)
+        return index
+
+    def _pullAppProcess(self, libdir=None):
+        libdir = libdir or self.libdir
         names = ['system/bin/app_process32', 'system/bin/app_process']
         for name in names:
-            dstpath = os.path.join(self.libdir, name.replace('/', os.sep))
+            dstpath = os.path.join(libdir, name.replace('/', os.sep))
             if os.path.exists(dstpath):
                 return os.path.basename(name)
-            os.makedirs(os.path.dirname(dstpath))
+            try:
+                os.makedirs(os.path.dirname(dstpath))
+            except OSError:
+                pass # exists, possibly created by another phase
 
             try:
                 adb.pull('/' + name, dstpath)
@@ -168,61 +486,60 @@ class FenInit(gdb.Command):
 
         raise gdb.GdbError('Could not find app process file')
 
-    def _pullLibsAndSetPaths(self):
-        # libraries/binaries to pull from device
-        DEFAULT_LIBS = ['system/lib/libdl.so', 'system/lib/libc.so',
-                'system/lib/libm.so', 'system/lib/libstdc++.so',
-                'system/lib/liblog.so', 'system/lib/libz.so',
-                'system/lib/libGLESv2.so', 'system/bin/linker']
-        # search path for above libraries/binaries
-        DEFAULT_SEARCH_PATHS = [['system', 'lib'],
-                                ['system', 'vendor', 'lib'],
-                                ['system', 'bin']]
+    def _pullSystemLibs(self, libdir=None):
+        # returns libraries that could not be pulled
+        libdir = libdir or self.libdir
+        failed = []
+        for lib in self.DEFAULT_LIBS:
+            try:
+                dstpath = os.path.join(libdir, lib.replace('/', os.sep))
+                if not os.path.exists(dstpath):
+                    adb.pull('/' + lib, dstpath)
+            except gdb.GdbError:
+                failed.append(lib)
+        return failed
 
-        datadir = str(gdb.parameter('data-directory'))
-        libdir = os.path.abspath(
-                os.path.join(datadir, os.pardir, 'lib', self.device))
-        self.datadir = datadir
-        self.libdir = libdir
-        self.bindir = os.path.abspath(
-                os.path.join(datadir, os.pardir, 'bin'))
+    def _pullLibsAndSetPaths(self):
+        libdir = self.libdir
 
         # always pull the executable file
-        self._appProcessName = self._pullAppProcess()
+        self._appProcessName = self._prefetched('appProcess',
+                                                self._pullAppProcess)
         print 'app process name: ' + self._appProcessName
 
         # only pull libs and set paths if automatically loading symbols
         if hasattr(self, 'skipPull') and not self.skipPull:
             sys.stdout.write('Pulling libraries to %s... ' % libdir)
             sys.stdout.flush()
-            for lib in DEFAULT_LIBS:
-                try:
-                    dstpath = os.path.join(libdir, lib.replace('/', os.sep))
-                    if not os.path.exists(dstpath):
-                        adb.pull('/' + lib, dstpath)
-                except gdb.GdbError:
-                    sys.stdout.write('\n cannot pull %s... ' % lib)
-                    sys.stdout.flush()
+            for lib in self._prefetched('systemLibs', self._pullSystemLibs):
+                sys.stdout.write('\n cannot pull %s... ' % lib)
+                sys.stdout.flush()
             print 'Done'
 
         gdb.execute('set sysroot ' + libdir, False, True)
         print 'Set sysroot to "%s".' % libdir
 
-        searchPaths = [os.path.join(libdir, os.path.join(*d)) \
-                for d in DEFAULT_SEARCH_PATHS]
-        if self.objdir:
-            searchPaths.append(os.path.join(self.objdir, 'dist', 'bin'))
-            searchPaths.append(os.path.join(self.objdir, 'dist', 'lib'))
         gdb.execute('set solib-search-path ' +
-                os.pathsep.join(searchPaths), False, True)
+                self._searchPaths(libdir, self.objdir), False, True)
         print 'Updated solib-search-path.'
 
         # Pass background hang monitor signal (assuming SIG36)
         gdb.execute('handle SIG36 nostop noprint pass', False, True)
         print 'Ignoring BHM signal.'
 
+    def _searchPaths(self, libdir, objdir):
+        searchPaths = [os.path.join(libdir, os.path.join(*d)) \
+                for d in self.DEFAULT_SEARCH_PATHS]
+        if objdir:
+            searchPaths.append(os.path.join(objdir, 'dist', 'bin'))
+            searchPaths.append(os.path.join(objdir, 'dist', 'lib'))
+        return os.pathsep.join(searchPaths)
+
     def _extractApk(self, pkg, bindir, libdir):
-        sys.stdout.write('Pulling apk for symbols... ')
+        # number of szip processes to run at once
+        SZIP_JOBS = 4
+
+        sys.stdout.write('Checking apk for symbols... ')
         sys.stdout.flush()
         apk = self._getPackageApk(pkg)
         if not apk:
@@ -243,63 +560,234 @@ class FenInit(gdb.Command):
             print '*** Could not find szip tool ***'
             return
 
-        import zipfile
+        # libraries extracted from an apk are kept until the apk changes
         appdir = os.path.join(libdir, 'app', pkg)
-        if os.path.isdir(appdir):
-            shutil.rmtree(appdir, ignore_errors=True)
-        apppath = os.path.join(appdir, 'app.apk')
-        adb.pull(apk, apppath)
-        print 'Done'
+        marker = os.path.join(appdir, '.apk')
+        apkid = self._deviceFileHash(apk) or \
+                adb.call(['shell', 'ls', '-l', apk]).strip()
+        try:
+            with open(marker, 'r') as f:
+                extracted = f.read() == apkid
+        except IOError:
+            extracted = False
 
-        sys.stdout.write('Extracting apk... ')
-        sys.stdout.flush()
+        if extracted:
+            print 'Unchanged'
+        else:
+            if os.path.isdir(appdir):
+                shutil.rmtree(appdir, ignore_errors=True)
+            os.makedirs(appdir)
+            if self._pullApkLibs(apk, appdir):
+                print 'Done'
+            else:
+                apppath = os.path.join(appdir, 'app.apk')
+                adb.pull(apk, apppath)
+                print 'Done'
+                sys.stdout.write('Extracting apk... ')
+                sys.stdout.flush()
+                self._extractApkLibs(apppath, appdir)
+                os.remove(apppath)
+                print 'Done'
+
+            sys.stdout.write('Un-szipping solibs... ')
+            sys.stdout.flush()
+            sofiles = [os.path.join(root, sofile)
+                       for root, dirnames, filenames in os.walk(appdir)
+                       for sofile in filenames if sofile.endswith('.so')]
+            def unszip(sofile):
+                with open(os.devnull, 'w') as devnull:
+                    return subprocess.call([szip, '-d', sofile],
+                            stdout=devnull, stderr=devnull)
+            if sofiles:
+                # each job is a separate szip process
+                pool = ThreadPool(min(SZIP_JOBS, len(sofiles)))
+                try:
+                    results = pool.map(unszip, sofiles)
+                finally:
+                    pool.close()
+                if any(results):
+                    raise gdb.GdbError('szip failed')
+            with open(marker, 'w') as f:
+                f.write(apkid)
+            print 'Done'
+
+        dirs = [gdb.parameter('solib-search-path')]
+        for root, dirnames, filenames in os.walk(appdir):
+            if root not in dirs and any(fn.endswith('.so')
+                                        for fn in filenames):
+                dirs.append(root)
+        gdb.execute('set solib-search-path ' + os.pathsep.join(dirs), False, True)
+        print 'Updated solib-search-path'
+
+    # apk directories holding libraries; Fennec keeps its szipped
+    # libraries (libxul.so and others) under assets/<abi>/
+    APK_LIB_DIRS = ('lib', 'assets')
+
+    def _isApkLib(self, name):
+        return name.split('/', 1)[0] in self.APK_LIB_DIRS and \
+               name.endswith('.so')
+
+    def _pullApkLibs(self, apk, appdir):
+        # if the device has unzip, extract only the libraries there and
+        # pull them, instead of pulling the whole apk
+        tmpdir = '/data/local/tmp/feninit-apk'
+        patterns = ' '.join('"%s/*.so"' % d for d in self.APK_LIB_DIRS)
+        # unzip exits with 11 if a pattern has no matches
+        out = adb.call(['shell', 'rm -rf %s; unzip -o -q "%s" %s -d %s '
+                '>/dev/null 2>&1; r=$?; [ $r = 0 -o $r = 11 ] && ls %s' %
+                (tmpdir, apk, patterns, tmpdir, tmpdir)],
+                stderr=subprocess.PIPE)
+        try:
+            dirs = [d for d in out.split() if d in self.APK_LIB_DIRS]
+            if not dirs:
+                return False
+            for d in dirs:
+                adb.pull(tmpdir + '/' + d, os.path.join(appdir, d))
+        finally:
+            adb.call(['shell', 'rm', '-rf', tmpdir], stderr=subprocess.PIPE)
+        return True
+
+    def _extractApkLibs(self, apppath, appdir):
+        import zipfile
         apkzip = zipfile.ZipFile(apppath, 'r')
         try:
+            names = [f for f in apkzip.namelist() if self._isApkLib(f)]
             if any(not os.path.realpath(os.path.join(appdir, f)).startswith(
                    os.path.realpath(appdir))
-                   for f in apkzip.namelist()):
+                   for f in names):
                 # extracted file will be outside of the destination directory
                 raise gdb.GdbError('Invalid apk file')
-            apkzip.extractall(appdir)
+            apkzip.extractall(appdir, names)
         finally:
             apkzip.close()
-        print 'Done'
-
-        sys.stdout.write('Un-szipping solibs... ')
-        sys.stdout.flush()
-        dirs = [gdb.parameter('solib-search-path')]
-        with open(os.devnull, 'w') as devnull:
-            for root, dirnames, filenames in os.walk(appdir):
-                for sofile in (fn for fn in filenames if fn.endswith('.so')):
-                    subprocess.check_call([szip, '-d', os.path.join(root, sofile)],
-                        stdout=devnull, stderr=devnull)
-                    if root not in dirs:
-                        dirs.append(root)
-        print 'Done'
 
-        gdb.execute('set solib-search-path ' + os.pathsep.join(dirs), False, True)
-        print 'Updated solib-search-path'
-
-    def _getPackageApk(self, pkg):
+    def _getDevicePackages(self):
+        # returns {package: apk path}, or None if the list is unavailable
         devpkgs = adb.call(['shell', 'pm', 'list', 'packages', '-f'])
         if not devpkgs.strip():
             return None
+        pkgs = {}
         for devpkg in (l.strip() for l in devpkgs.splitlines()):
             if not devpkg:
                 continue
             # devpkg has the format 'package:/data/app/pkg.apk=pkg'
-            devpkg = devpkg.partition('=')
-            if pkg != devpkg[2]:
-                continue
-            return devpkg[0].partition(':')[2]
-        return ''
+            devpkg = devpkg.rpartition('=')
+            pkgs[devpkg[2]] = devpkg[0].partition(':')[2]
+        return pkgs
 
-    def _verifyPackage(self, objdir, pkg):
-        if not objdir or not pkg:
+    def _getPackageApk(self, pkg):
+        devpkgs = self._prefetched('devicePackages', self._getDevicePackages)
+        if devpkgs is None:
+            return None
+        return devpkgs.get(pkg, '')
+
+    def _listDeviceApks(self, apks):
+        # returns {apk path: 'ls -l' output}
+        if not apks:
+            return {}
+        out = adb.call(['shell', '; '.join(
+                'echo "@ %s"; ls -l "%s"' % (apk, apk) for apk in apks)])
+        listing = {}
+        apk = None
+        for line in out.splitlines():
+            if line.startswith('@ '):
+                apk = line[2:].strip()
+            elif apk and line.strip():
+                listing[apk] = line.strip()
+        return listing
+
+    def _deviceFileHash(self, path):
+        # returns the sha1 or md5 hex digest of a device file, using
+        # whichever tool the device has, or '' if neither is available
+        out = adb.call(['shell',
+                'sha1sum "%s" 2>/dev/null || md5sum "%s" 2>/dev/null' %
+                (path, path)], stderr=subprocess.PIPE).split()
+        digest = out[0].lower() if out else ''
+        if len(digest) not in (32, 40) or \
+                digest.strip('0123456789abcdef'):
+            return ''
+        return digest
+
+    def _verifiedApkName(self, pkg):
+        return 'apk-' + cache.key(adb.getDevice(), pkg)
+
+    def _localApkState(self, apk):
+        st = os.stat(apk)
+        return [os.path.abspath(apk), st.st_size, st.st_mtime]
+
+    def _saveVerifiedApk(self, pkg, apk, devapkls=None):
+        # remember that the installed package matches the local apk
+        if devapkls is None:
+            devapk = self._getPackageApk(pkg)
+            if not devapk:
+                return
+            devapkls = adb.call(['shell', 'ls', '-l', devapk]).strip()
+        cache.save(self._verifiedApkName(pkg), {
+            'local': self._localApkState(apk),
+            'remote': devapkls,
+        })
+
+    def _matchApk(self, pkg, apk, devapk, devapkls, quiet=False):
+        # returns True if the installed apk matches the local apk,
+        # False if it does not, or None if we cannot tell
+        def status(msg):
+            if not quiet:
+                sys.stdout.write(msg)
+                sys.stdout.flush()
+
+        verified = cache.load(self._verifiedApkName(pkg), {})
+        if verified.get('local') == self._localApkState(apk) and \
+                verified.get('remote') == devapkls:
+            # neither apk has changed since they were last compared
             return True
-        # get base package name without any webapp part
-        pkg = pkg.partition(':')[0]
 
+        devapksize = [int(f, 0) for f in devapkls.split()
+                if f.isdigit() and int(f, 0) > 1024 * 1024]
+        if not devapksize:
+            return None
+        if devapksize[0] != os.path.getsize(apk):
+            return False
+
+        # same size; compare hashes
+        status('Comparing apk checksums... ')
+        devapkhash = self._deviceFileHash(devapk)
+        algo = {40: hashlib.sha1, 32: hashlib.md5}.get(len(devapkhash))
+        if not algo:
+            # no checksum tool on device; the sizes match, so the apks
+            # match unless the local apk changed since it was installed
+            status('Unavailable\n')
+            match = verified.get('remote') != devapkls
+        else:
+            h = algo()
+            with open(apk, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                    h.update(chunk)
+            match = h.hexdigest() == devapkhash
+            status('Match\n' if match else 'Mismatch\n')
+        if match:
+            self._saveVerifiedApk(pkg, apk, devapkls)
+        return match
+
+    def _installApk(self, apk):
+        # returns the last line of adb output; streaming install avoids
+        # copying the apk to a temporary location on the device first
+        args = [['install', '-r', apk]]
+        if adb.getSdkVersion() >= 21:
+            args.insert(0, ['install', '-r', '--streaming', apk])
+        for arg in args:
+            try:
+                adbout = adb.call(arg, stderr=subprocess.PIPE).splitlines()
+            except gdb.GdbError:
+                adbout = []
+            adbout = [f for f in adbout if f.strip()]
+            if adbout and 'success' in adbout[-1].lower():
+                break
+        if not adbout:
+            adbout = ['No output?!']
+        return adbout[-1].strip()
+
+    def _findApk(self, objdir):
+        # returns the newest apk in objdir, or None
         apkprefix = self._getAppName(objdir) + '-'
         apks = []
         distdir = os.path.join(objdir, 'dist')
@@ -307,11 +795,21 @@ class FenInit(gdb.Command):
             if f.lower().startswith(apkprefix) and f.lower().endswith('.apk'):
                 apks.append(os.path.join(distdir, f))
         if not apks:
+            return None
+        apks.sort(key=lambda f: os.path.getmtime(f))
+        return apks[-1]
+
+    def _verifyPackage(self, objdir, pkg):
+        if not objdir or not pkg:
+            return True
+        # get base package name without any webapp part
+        pkg = pkg.partition(':')[0]
+
+        apk = self._findApk(objdir)
+        if not apk:
             print '*** Did not find an APK file in your object  ***'
             print '*** directory; did you choose the right one? ***'
             return True
-        apks.sort(key=lambda f: os.path.getmtime(f))
-        apk = apks[-1]
 
         while True:
             devapk = self._getPackageApk(pkg)
@@ -320,12 +818,11 @@ class FenInit(gdb.Command):
                 return True
 
             if devapk:
-                devapkls = adb.call(['shell', 'ls', '-l', devapk])
-                devapksize = [int(f, 0) for f in devapkls.split()
-                        if f.isdigit() and int(f, 0) > 1024 * 1024]
-                if not devapksize:
-                    return True
-                if devapksize[0] == os.path.getsize(apk):
+                devapkls = self._prefetched('deviceApks',
+                        self._listDeviceApks, [devapk]).get(devapk) or \
+                        adb.call(['shell', 'ls', '-l', devapk]).strip()
+                match = self._matchApk(pkg, apk, devapk, devapkls)
+                if match is None or match:
                     return True
 
             if devapk:
@@ -337,26 +834,24 @@ class FenInit(gdb.Command):
             while not ans or (ans[0] != 'y' and ans[0] != 'Y' and
                               ans[0] != 'n' and ans[0] != 'N'):
                 ans = readinput.call('Reinstall apk? [yes/no]: ',
-                        '-l', str(['yes', 'no']))
+                        '-l', ['yes', 'no'])
             print
             if ans[0] == 'n' or ans[0] == 'N':
                 return False
             sys.stdout.write('adb install -r... ')
             sys.stdout.flush()
-            adbout = adb.call(['install', '-r', apk],
-                    stderr=subprocess.PIPE).splitlines()
-            adbout = [f for f in adbout if f.strip()]
-            if not adbout:
-                adbout = ['No output?!']
-            print adbout[-1]
-            if 'success' in adbout[-1].lower():
-                continue
+            self._invalidate('devicePackages', 'deviceApks')
+            adbout = self._installApk(apk)
+            print adbout
+            if 'success' in adbout.lower():
+                self._saveVerifiedApk(pkg, apk)
+                return True
 
             ans = None
             while not ans or (ans[0] != 'y' and ans[0] != 'Y' and
                               ans[0] != 'n' and ans[0] != 'N'):
                 ans = readinput.call('Uninstall then install? [yes/no]: ',
-                        '-l', str(['yes', 'no']))
+                        '-l', ['yes', 'no'])
             print
             if ans[0] == 'n' or ans[0] == 'N':
                 return False
@@ -366,12 +861,7 @@ class FenInit(gdb.Command):
                     stderr=subprocess.PIPE)
             sys.stdout.write('\nadb install... ');
             sys.stdout.flush()
-            adbout = adb.call(['install', '-r', apk],
-                    stderr=subprocess.PIPE).splitlines()
-            adbout = [f for f in adbout if f.strip()]
-            if not adbout:
-                adbout = ['No output?!']
-            print adbout[-1]
+            print self._installApk(apk)
 
     def _getAppName(self, objdir):
         try:
@@ -404,7 +894,8 @@ class FenInit(gdb.Command):
                         webapppkg = ':' + pkgs[0] + '.WebApp'
                         webapppkg2 = ':' + pkgs[0] + '.Webapp'
                         pkgs.extend([re.split(r'[ \t/]', p.strip())[-1]
-                            for p in self._getRunningProcs(None)
+                            for p in self._prefetched('runningProcs',
+                                self._getRunningProcs, None)
                             if webapppkg in p or webapppkg2 in p])
                     if len(pkgs) < 2:
                         acfile.close()
@@ -414,9 +905,9 @@ class FenInit(gdb.Command):
             except IOError:
                 pass
         if not pkgs:
-            pkgs = [x.partition(':')[-1] for x in \
-                adb.call(['shell', 'pm', 'list', 'packages']).splitlines() \
-                if ':org.mozilla.' in x]
+            pkgs = sorted(p for p in (self._prefetched('devicePackages',
+                                      self._getDevicePackages) or {})
+                          if p.startswith('org.mozilla.'))
         if pkgs:
             print 'Found package names:'
             for pkg in pkgs:
@@ -427,7 +918,7 @@ class FenInit(gdb.Command):
         pkg = None
         while not pkg:
             pkg = readinput.call(
-                'Use package (e.g. org.mozilla.fennec): ', '-l', str(pkgs))
+                'Use package (e.g. org.mozilla.fennec): ', '-l', pkgs)
         print ''
         return pkg
 
@@ -437,31 +928,155 @@ class FenInit(gdb.Command):
                 (not pkg or pkg in re.split(r'[ \t/]', x)) and
                 (not waiting or 'S' in x.split() or 'T' in x.split())]
 
+    def _watchProcs(self, pkg):
+        # start watching processes of pkg, or reuse the current watcher
+        watcher = getattr(self, '_watcher', None)
+        if watcher and watcher.running and watcher.pkg == pkg:
+            return watcher
+        self._stopWatcher()
+        watcher = procwatch.ProcessWatcher(pkg)
+        watcher.start()
+        self._watcher = watcher
+        return watcher
+
+    def _stopWatcher(self):
+        if hasattr(self, '_watcher'):
+            self._watcher.terminate()
+            delattr(self, '_watcher')
+
+    def _followChildren(self, pkg, watcher, parentPid, childName, filePath):
+        # attach gdbserver to each new child of parentPid as soon as the
+        # watcher sees it, so the child is stopped early in its startup;
+        # gdb connects it as a new inferior when the program next stops
+        known = set(p.pid for p in watcher.procs)
+        pending = []
+        lock = threading.Lock()
+
+        def connectPending():
+            # runs on the main thread through gdb.post_event
+            if adblog.continuing:
+                # commands cannot run while the program runs; interrupt
+                # it, and connect from the stop handler
+                adblog.interrupt()
+                return
+            with lock:
+                children = pending[:]
+                del pending[:]
+            if not children:
+                return
+            current = gdb.selected_inferior().num
+            for pid, proc, port in children:
+                try:
+                    num = self._connectInferior(filePath, port)
+                except gdb.error, e:
+                    print 'Cannot connect to child process %s: %s' % (pid, e)
+                    continue
+                self.gdbservers.append(proc)
+                self.inferiors[pid] = num
+                print '[Child process %s attached as inferior %d]' % (pid, num)
+            gdb.execute('inferior %d' % current, False, True)
+
+        def attach(pid):
+            # an intent would restart the app being debugged
+            try:
+                (proc, port, intentPid) = self._startGDBServer(pkg,
+                        ['--once', '--attach', ':0', pid], quiet=True,
+                        allowIntent=False)
+            except gdb.GdbError:
+                sys.__stderr__.write('Cannot attach to child process %s\n'
+                                     % pid)
+                return
+            outputThd = threading.Thread(name='GDBServer',
+                                         target=proc.communicate)
+            outputThd.daemon = True
+            outputThd.start()
+            adb.forward('tcp:' + port, 'tcp:' + port)
+            with lock:
+                pending.append((pid, proc, port))
+            gdb.post_event(connectPending)
+
+        def processesChanged(old, new):
+            # runs on the watcher thread; don't block it while attaching
+            for proc in new:
+                if proc.pid in known:
+                    continue
+                known.add(proc.pid)
+                if proc.ppid == parentPid and childName in proc.name:
+                    attachThd = threading.Thread(name='FollowChild',
+                                                 target=attach,
+                                                 args=(proc.pid,))
+                    attachThd.daemon = True
+                    attachThd.start()
+
+        def stopped(event):
+            if pending:
+                gdb.post_event(connectPending)
+
+        self.inferiors.setdefault(self.pid, gdb.selected_inferior().num)
+        watcher.addListener(processesChanged)
+        gdb.events.stop.connect(stopped)
+        self._following = (watcher, stopped)
+        # keep the watcher running after feninit returns
+        if getattr(self, '_watcher', None) is watcher:
+            delattr(self, '_watcher')
+        print 'Following new child processes of pid %s.' % parentPid
+
+    def _stopFollowing(self):
+        if hasattr(self, '_following'):
+            watcher, stopped = self._following
+            watcher.terminate()
+            gdb.events.stop.disconnect(stopped)
+            delattr(self, '_following')
+
+    def _waitForExit(self, pids, timeout):
+        # returns the pids that are still running after timeout; polls
+        # /proc with exponential backoff, so exits are noticed quickly
+        delay = 0.05
+        end = time.time() + timeout
+        while pids:
+            out = adb.call(['shell', 'for p in %s; do '
+                    '[ -d /proc/$p ] && echo $p; done; true' % ' '.join(pids)],
+                    stderr=subprocess.PIPE)
+            pids = [pid for pid in out.split() if pid in pids]
+            if not pids or time.time() >= end:
+                break
+            time.sleep(min(delay, max(end - time.time(), 0)))
+            delay = min(delay * 2, 1.0)
+        return pids
+
     def _killRunningProcs(self, pkg):
-        pkgProcs = self._getRunningProcs(pkg)
-        if not pkgProcs:
-            return
+        # seconds to wait for processes to exit after force-stop, and
+        # in total for kill rounds; Android may respawn processes with
+        # new pids, so the processes are listed again after each round
+        FORCE_STOP_TIMEOUT = 3
+        KILL_TIMEOUT = 4
+        # seconds to wait for processes to exit after one kill round
+        KILL_ROUND_TIMEOUT = 1
+
+        def runningPids(pkgProcs):
+            return [next(c for c in p.split() if c.isdigit())
+                    for p in pkgProcs]
 
-        adb.call(['shell', 'am', 'force-stop', pkg])
-        time.sleep(3)
         pkgProcs = self._getRunningProcs(pkg)
         if not pkgProcs:
             return
+        adb.call(['shell', 'am', 'force-stop', pkg])
+        self._waitForExit(runningPids(pkgProcs), FORCE_STOP_TIMEOUT)
 
-        try:
-            # try twice
-            for i in range(2):
-                for p in pkgProcs:
-                    adb.call(['shell', 'run-as', pkg, 'kill', '-9',
-                              next(c for c in p.split() if c.isdigit())])
-                time.sleep(2)
-                pkgProcs = self._getRunningProcs(pkg)
-                if not pkgProcs:
-                    return
-        except:
-            pass
-
+        end = time.time() + KILL_TIMEOUT
         pkgProcs = self._getRunningProcs(pkg)
+        while pkgProcs and time.time() < end:
+            pids = runningPids(pkgProcs)
+            try:
+                # kill all processes using one shell command
+                adb.call(['shell', '; '.join(
+                        'run-as %s kill -9 %s' % (pkg, pid) for pid in pids)],
+                        stderr=subprocess.PIPE)
+            except gdb.GdbError:
+                pass
+            self._waitForExit(pids, min(KILL_ROUND_TIMEOUT,
+                                        max(end - time.time(), 0)))
+            pkgProcs = self._getRunningProcs(pkg)
         if not pkgProcs:
             return
         for p in pkgProcs:
@@ -510,55 +1125,114 @@ class FenInit(gdb.Command):
             print out
             raise gdb.GdbError('Error while launching %s.' % pkg)
 
+    def _readJavaPackage(self, filename):
+        # returns the package declared in a java source file, or None
+        try:
+            with open(filename, 'r') as f:
+                for line in f:
+                    sline = line.split(';')[0].strip().split()
+                    if len(sline) == 2 and sline[0] == 'package':
+                        return sline[1]
+        except IOError:
+            pass
+        return None
+
     def _linkJavaSources(self, srcdir, objdir):
+        # number of threads used to read package names from sources
+        PARSE_THREADS = 8
+
         # top dir of symbolic links
         targetdir = os.path.join(objdir, 'mobile', 'android', 'base', 'jdb')
         if not os.path.isdir(targetdir):
             os.makedirs(targetdir)
-        # list of already linked java files
-        knownSources = []
+        # skip 'classes' dir which contains only '.class' files
+        objdirclasses = os.path.join(objdir,
+            'mobile', 'android', 'base', 'classes')
+
+        # manifest has the format {source path: [mtime, package]}
+        manifestPath = os.path.join(targetdir, '.manifest')
+        try:
+            with open(manifestPath, 'r') as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            manifest = {}
+
+        # set of already linked java files
+        links = set()
         for dirpath, dirnames, filenames in os.walk(targetdir):
-            knownSources += [os.path.normpath(os.path.join(dirpath,
-                os.readlink(os.path.join(dirpath, filename))))
-                for filename in filenames]
-        # link to a single source file
-        def linkSource(filename):
-            target = None
-            with open(filename, 'r') as f:
-                for line in f:
-                    sline = line.split(';')[0].strip().split()
-                    if len(sline) != 2 or sline[0] != 'package':
-                        continue
-                    # create java-style source dirs
-                    target = os.path.join(*([targetdir] + sline[1].split('.')))
-                    if not os.path.isdir(target):
-                        os.makedirs(target)
-                    break
-            if not target:
-                return
-            # create relative symbolic link
-            linkname = os.path.join(target, os.path.basename(filename))
-            linktarget = os.path.relpath(filename, target)
-            if not os.path.exists(linkname):
-                os.symlink(linktarget, linkname)
-        def linkSourceDir(root):
-            # skip 'classes' dir which contains only '.class' files
-            objdirclasses = os.path.join(objdir,
-                'mobile', 'android', 'base', 'classes')
+            links.update(os.path.join(dirpath, f) for f in filenames)
+
+        # sources in link order; the first source for a link wins
+        sources = []
+        mtimes = {}
+        for root in (os.path.join(srcdir, 'mobile', 'android', 'base'),
+                     os.path.join(objdir, 'mobile', 'android', 'base')):
             for dirpath, dirnames, filenames in os.walk(root):
-                if dirpath.startswith(targetdir) or \
-                    dirpath.startswith(objdirclasses):
-                    continue
-                for filename in filenames:
+                dirnames[:] = [d for d in sorted(dirnames)
+                               if os.path.join(dirpath, d) not in
+                                  (targetdir, objdirclasses)]
+                for filename in sorted(filenames):
                     if not filename.endswith('.java'):
                         continue
                     filename = os.path.join(dirpath, filename)
-                    if filename in knownSources:
-                        return
-                    linkSource(filename)
+                    try:
+                        mtimes[filename] = os.stat(filename).st_mtime
+                    except OSError:
+                        continue
+                    sources.append(filename)
+
+        # only read sources that are new or changed since last time
+        changed = []
+        newManifest = {}
+        for f in sources:
+            entry = manifest.get(f)
+            if entry and entry[0] == mtimes[f]:
+                newManifest[f] = entry
+            else:
+                changed.append(f)
+        if changed:
+            pool = ThreadPool(min(PARSE_THREADS, len(changed)))
+            try:
+                packages = pool.map(self._readJavaPackage, changed)
+            finally:
+                pool.close()
+            for filename, package in zip(changed, packages):
+                newManifest[filename] = [mtimes[filename], package]
+
+        def linkName(filename, package):
+            # java-style source dirs
+            return os.path.join(*([targetdir] + package.split('.') +
+                                  [os.path.basename(filename)]))
+
+        # remove links to sources that were removed or changed package
+        for filename, (mtime, package) in manifest.iteritems():
+            if not package or (filename in newManifest and
+                               newManifest[filename][1] == package):
+                continue
+            linkname = linkName(filename, package)
+            if linkname in links:
+                os.remove(linkname)
+                links.remove(linkname)
+
+        for filename in sources:
+            package = newManifest[filename][1]
+            if not package:
+                continue
+            linkname = linkName(filename, package)
+            if linkname in links:
+                continue
+            target = os.path.dirname(linkname)
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            # create relative symbolic link
+            os.symlink(os.path.relpath(filename, target), linkname)
+            links.add(linkname)
 
-        linkSourceDir(os.path.join(srcdir, 'mobile', 'android', 'base'))
-        linkSourceDir(os.path.join(objdir, 'mobile', 'android', 'base'))
+        try:
+            with open(manifestPath, 'w') as f:
+                json.dump(newManifest, f)
+        except IOError:
+            pass
         return targetdir
 
     def _attach(self, pkg, use_jdb):
@@ -577,19 +1251,19 @@ class FenInit(gdb.Command):
         else:
             CHILD_FILE_PATH = None
 
-        # get parent/child processes that are waiting ('S' state)
-        pkgProcs = self._getRunningProcs(pkg, waiting=True)
+        # watch parent/child processes that are waiting ('S' state)
+        watcher = self._watchProcs(pkg)
 
         # wait for parent launch to complete
-        while all([CHILD_EXECUTABLE in x for x in pkgProcs]):
-            pkgProcs = self._getRunningProcs(pkg, waiting=True)
+        parent = watcher.waitForParent(CHILD_EXECUTABLE)
+        if not parent:
+            raise gdb.GdbError('Lost connection to device.')
         print 'Done'
 
         # get parent/child(ren) pid's
-        pidParent = next((next((col for col in x.split() if col.isdigit()))
-                for x in pkgProcs if CHILD_EXECUTABLE not in x))
-        pidChild = [next((col for col in x.split() if col.isdigit()))
-                for x in pkgProcs if CHILD_EXECUTABLE in x]
+        pidParent = next(p.pid for p in parent
+                         if CHILD_EXECUTABLE not in p.name)
+        pidChild = [p.pid for p in parent if CHILD_EXECUTABLE in p.name]
         pidChildParent = pidParent
 
         # see if any gdbserver instance is running, and discard
@@ -609,6 +1283,21 @@ class FenInit(gdb.Command):
             elif pid in pidChild:
                 pidChild.remove(pid)
 
+        # with attach_all, attach to the parent and all children at once
+        targets = ([(pidParent, PARENT_FILE_PATH)] if pidParent else []) + \
+                  [(pid, CHILD_FILE_PATH or PARENT_FILE_PATH)
+                   for pid in pidChild]
+        follow = not use_jdb and getattr(self, 'follow_children', False) \
+                 and self._supportsMultiTarget()
+        if not use_jdb and getattr(self, 'attach_all', False) and \
+                len(targets) > 1 and self._supportsMultiTarget() and \
+                self._attachAll(pkg, targets):
+            if follow:
+                self._followChildren(pkg, watcher, pidChildParent,
+                        CHILD_EXECUTABLE, CHILD_FILE_PATH or PARENT_FILE_PATH)
+            print '\nReady. Use "continue" to resume execution.'
+            return
+
         if not use_jdb and pidParent:
             # the parent is not being debugged, pick the parent
             pidAttach = pidParent
@@ -646,14 +1335,12 @@ class FenInit(gdb.Command):
         elif not pidChild:
             # ok, no child is available. assume the user
             # wants to wait for child to start up
-            pkgProcs = []
             print 'Waiting for child process...'
-            while not any(pidChildParent in x and
-                          CHILD_EXECUTABLE in x for x in pkgProcs):
-                pkgProcs = self._getRunningProcs(pkg, waiting=True)
-                time.sleep(1)
-            pidChild = [next((col for col in x.split() if col.isdigit()))
-                        for x in pkgProcs]
+            children = watcher.waitForChildren(pidChildParent,
+                                               CHILD_EXECUTABLE)
+            if not children:
+                raise gdb.GdbError('Lost connection to device.')
+            pidChild = [p.pid for p in children]
 
         # if the parent was not picked, pick the right child
         if not pidParent and len(pidChild) == 1:
@@ -668,10 +1355,10 @@ class FenInit(gdb.Command):
                 print 'WTF multiple child processes found:'
                 for i in range(len(pidChild)):
                     print '%d. pid %s' % (i + 1, pidChild[i])
-                pidAttach = readinput.call('Child pid: ', '-l', str(pidChild))
+                pidAttach = readinput.call('Child pid: ', '-l', pidChild)
                 if pidAttach.isdigit() and int(pidAttach) > 0 \
                         and int(pidAttach) <= len(pidChild):
-                    pidAttach = pidChild[pidAttach]
+                    pidAttach = pidChild[int(pidAttach) - 1]
             sys.stdout.write('\nAttaching... ')
             sys.stdout.flush()
         self.pid = pidAttach
@@ -682,6 +1369,9 @@ class FenInit(gdb.Command):
                 pkg,
                 (PARENT_FILE_PATH if pidParent else CHILD_FILE_PATH),
                 ['--once', '--attach', gdbserver_port, pidAttach])
+        if follow:
+            self._followChildren(pkg, watcher, pidChildParent,
+                    CHILD_EXECUTABLE, CHILD_FILE_PATH or PARENT_FILE_PATH)
 
         print '\nReady. Use "continue" to resume execution.'
 
@@ -692,22 +1382,50 @@ class FenInit(gdb.Command):
         self.pid = pid
         gdbserver_port = ':' + str(self.gdbserver_port
                 if hasattr(self, 'gdbserver_port') else 0)
+        # the process was picked by the user, so don't restart the app
         self._attachGDBServer(
                 pkg,
                 path,
-                ['--once', '--attach', gdbserver_port, pid])
+                ['--once', '--attach', gdbserver_port, pid],
+                allowIntent=False)
 
         print '\nReady. Use "continue" to resume execution.'
 
-    def _attachGDBServer(self, pkg, filePath, args,
-                         skipShell = False, redirectOut = False):
-        # get base package name without any webapp part
+    # names of gdbserver launch strategies, in the order they are tried,
+    # and the labels used for their output when all of them fail
+    GDBSERVER_STRATEGIES = [
+        ('shell', 'gdbserver'),
+        ('run-as', 'run-as'),
+        ('run-as-pkg', 'run-as pkg'),
+        ('su', 'su -c'),
+        ('su-pkg', 'su -c pkg'),
+        ('intent', 'am start'),
+    ]
+
+    def _gdbserverStrategyKey(self, pkg, args):
+        # a strategy that works for launching a program, such as 'intent',
+        # may restart the app or fail when attaching, so each mode is
+        # remembered separately
+        mode = 'attach' if '--attach' in args else \
+               'multi' if '--multi' in args else 'launch'
+        return cache.key(adb.getDevice(), adb.getFingerprint(), pkg, mode)
+
+    def _startGDBServer(self, pkg, args, skipShell=False, quiet=False,
+                        logPath=None, allowIntent=True):
+        # returns (proc, port, intentPid); does not use gdb, so it can be
+        # called from any thread. If logPath is given, output goes to that
+        # file instead of a pipe, so gdbserver can outlive gdb. Launching
+        # through an intent restarts the app, so pass allowIntent=False
+        # when attaching to a process that must keep running
         pkg = pkg.partition(':')[0]
 
-        # always push gdbserver in case there's an old version on the device
-        gdbserverPath = '/data/local/tmp/gdbserver'
-        adb.push(os.path.join(self.bindir, 'gdbserver'), gdbserverPath)
-        adb.call(['shell', 'chmod', '755', gdbserverPath])
+        gdbserverPath = self._prefetched('gdbserver', self._pushGDBServer)
+        pkgGdbserverPath = '/data/data/' + pkg + '/files/gdbserver'
+
+        def status(msg):
+            if not quiet:
+                sys.stdout.write(msg)
+                sys.stdout.flush()
 
         # run this after fork() and before exec(gdbserver)
         # so 'adb shell gdbserver' doesn't get gdb's signals
@@ -715,8 +1433,24 @@ class FenInit(gdb.Command):
             os.setpgrp()
 
         def runGDBServer(args): # returns (proc, port, stdout)
-            proc = adb.call(args, stderr=subprocess.STDOUT, async=True,
-                    preexec_fn=gdbserverPreExec)
+            if logPath:
+                with open(logPath, 'w') as log, \
+                        open(os.devnull, 'r') as devnull:
+                    proc = adb.call(args, stdin=devnull, stdout=log,
+                            stderr=subprocess.STDOUT, async=True,
+                            preexec_fn=gdbserverPreExec)
+                output = open(logPath, 'r')
+                def readline():
+                    # follow the log file until a line is complete
+                    line = output.readline()
+                    while not line.endswith('\n') and proc.poll() is None:
+                        time.sleep(0.05)
+                        line += output.readline()
+                    return line
+            else:
+                proc = adb.call(args, stderr=subprocess.STDOUT, async=True,
+                        preexec_fn=gdbserverPreExec)
+                readline = proc.stdout.readline
             need_watchdog = True
             def watchdog():
                 time.sleep(10)
@@ -729,114 +1463,169 @@ class FenInit(gdb.Command):
             # have multiple gdbservers running
             out = []
             line = ' '
-            while line:
-                line = proc.stdout.readline()
-                words = line.split()
-                out.append(line.rstrip())
-                if 'gdbserver terminated by' in line:
-                    break
-                # kind of hacky, assume the port number comes after 'port'
-                if 'port' not in words:
-                    continue
-                if words.index('port') + 1 == len(words):
-                    continue
-                port = words[words.index('port') + 1]
-                if not port.isdigit():
-                    continue
-                need_watchdog = False
-                return (proc, port, out)
+            try:
+                while line:
+                    line = readline()
+                    words = line.split()
+                    out.append(line.rstrip())
+                    if 'gdbserver terminated by' in line:
+                        break
+                    # kind of hacky, assume the port number comes after 'port'
+                    if 'port' not in words:
+                        continue
+                    if words.index('port') + 1 == len(words):
+                        continue
+                    port = words[words.index('port') + 1]
+                    if not port.isdigit():
+                        continue
+                    need_watchdog = False
+                    return (proc, port, out)
+            finally:
+                if logPath:
+                    # gdbserver keeps writing to the log, but we are done
+                    output.close()
             # not found, error?
             need_watchdog = False
             return (None, None, out)
 
-        # can we run as root?
-        gdbserverProc = None
-        gdbserverRootOut = ''
-        intentPid = None
-        if not skipShell:
-            gdbserverArgs = ['shell', gdbserverPath]
-            gdbserverArgs.extend(args)
-            (gdbserverProc, port, gdbserverRootOut) = runGDBServer(gdbserverArgs)
-
-        if not gdbserverProc:
-            sys.stdout.write('as non-root... ')
-            sys.stdout.flush()
-            gdbserverArgs = ['shell', 'run-as', pkg, gdbserverPath]
-            gdbserverArgs.extend(args)
-            (gdbserverProc, port, gdbserverRunAsOut) = \
-                    runGDBServer(gdbserverArgs)
+        def copyToPkg():
+            # copy only if the package copy is missing or has a different
+            # checksum; a missing checksum never counts as a match
+            adb.call(['shell', 'h=$(cat %(src)s.sha1 2>/dev/null); '
+                    '[ -n "$h" ] && [ "$h" = '
+                    '"$(run-as %(pkg)s cat %(dst)s.sha1 2>/dev/null)" ] && '
+                    'run-as %(pkg)s sh -c "[ -x %(dst)s ]" 2>/dev/null || '
+                    '{ run-as %(pkg)s cp %(src)s %(dst)s; '
+                    'run-as %(pkg)s chmod 755 %(dst)s; '
+                    'run-as %(pkg)s cp %(src)s.sha1 %(dst)s.sha1; }' % {
+                        'pkg': pkg, 'src': gdbserverPath,
+                        'dst': pkgGdbserverPath}])
 
-        if not gdbserverProc:
-            sys.stdout.write('in pkg dir... ')
-            sys.stdout.flush()
-            pkgGdbserverPath = '/data/data/' + pkg + '/files/gdbserver'
-            adb.call(['shell', 'run-as', pkg, 'cp', gdbserverPath, pkgGdbserverPath])
-            adb.call(['shell', 'run-as', pkg, 'chmod', '755', pkgGdbserverPath])
-            gdbserverArgs = ['shell', 'run-as', pkg, pkgGdbserverPath] + args
-            (gdbserverProc, port, gdbserverPkgRunAsOut) = \
-                    runGDBServer(gdbserverArgs)
-
-        if not gdbserverProc:
-            sys.stdout.write('as root... ')
-            sys.stdout.flush()
-            gdbserverArgs = [gdbserverPath] + args
-            adb.call(['shell', 'echo "#!/system/bin/sh\\n' +
-                    ' '.join(gdbserverArgs) + '" > ' + gdbserverPath + '.run'])
-            adb.call(['shell', 'chmod', '755', gdbserverPath + '.run'])
-            (gdbserverProc, port, gdbserverSuOut) = runGDBServer(
-                    ['shell', 'su', '-c', gdbserverPath + '.run'])
-
-        if not gdbserverProc:
-            sys.stdout.write('in pkg dir... ')
-            sys.stdout.flush()
-            gdbserverArgs = ['shell', 'su', '-c', pkgGdbserverPath] + args
-            (gdbserverProc, port, gdbserverPkgSuOut) = \
-                    runGDBServer(gdbserverArgs)
-
-        if not gdbserverProc:
-            sys.stdout.write('using intent... ')
-            sys.stdout.flush()
+        # can we run as root?
+        def runShell():
+            return runGDBServer(['shell', gdbserverPath] + args)
+
+        def runRunAs():
+            status('as non-root... ')
+            return runGDBServer(['shell', 'run-as', pkg, gdbserverPath] + args)
+
+        def runRunAsPkg():
+            status('in pkg dir... ')
+            copyToPkg()
+            return runGDBServer(
+                    ['shell', 'run-as', pkg, pkgGdbserverPath] + args)
+
+        def runSu():
+            status('as root... ')
+            # gdbservers may be started in parallel, so each attached
+            # pid gets its own script
+            script = '%s.%s.run' % (gdbserverPath, args[-1]) \
+                     if '--attach' in args else gdbserverPath + '.run'
+            adb.writeIfChanged('#!/system/bin/sh\n' +
+                    ' '.join([gdbserverPath] + args) + '\n', script)
+            return runGDBServer(['shell', 'su', '-c', script])
+
+        def runSuPkg():
+            status('in pkg dir... ')
+            copyToPkg()
+            return runGDBServer(['shell', 'su', '-c', pkgGdbserverPath] + args)
+
+        intent = {}
+        def runIntent():
+            status('using intent... ')
             self._killRunningProcs(pkg)
             adb.call(['logcat', '-c'])
             adb.call(['shell', 'am', 'start', '-W', '-n', pkg + '/org.mozilla.gecko.BrowserApp',
                       '-a', 'org.mozilla.gecko.DEBUG',
                       '--es', 'gdbserver', ' '.join(args)] +
                       getattr(self, 'amExtraArgs', []))
-            (gdbserverProc, port, gdbserverAmOut) = runGDBServer(
+            result = runGDBServer(
                     ['logcat', '-s', '-v', 'process', 'gdbserver:V'])
-            if gdbserverAmOut:
-                intentPid = gdbserverAmOut[0][2:7]
+            if result[2]:
+                intent['pid'] = result[2][0][2:7]
+            return result
+
+        runners = {
+            'shell': runShell,
+            'run-as': runRunAs,
+            'run-as-pkg': runRunAsPkg,
+            'su': runSu,
+            'su-pkg': runSuPkg,
+            'intent': runIntent,
+        }
+        strategies = [name for name, label in self.GDBSERVER_STRATEGIES
+                      if (name != 'shell' or not skipShell) and
+                         (name != 'intent' or allowIntent)]
+
+        # try the strategy that worked last time first
+        memoKey = self._gdbserverStrategyKey(pkg, args)
+        memo = cache.load('gdbserver-strategy', {})
+        if memo.get(memoKey) in strategies:
+            strategies.remove(memo[memoKey])
+            strategies.insert(0, memo[memoKey])
+
+        outputs = {}
+        for name in strategies:
+            (gdbserverProc, port, outputs[name]) = runners[name]()
+            if gdbserverProc:
+                break
 
-        if not gdbserverProc:
+        if gdbserverProc:
+            if memo.get(memoKey) != name:
+                memo[memoKey] = name
+                cache.save('gdbserver-strategy', memo)
+            return (gdbserverProc, port, intent.get('pid'))
+
+        if memoKey in memo:
+            del memo[memoKey]
+            cache.save('gdbserver-strategy', memo)
+        if not quiet:
             print ''
-            if gdbserverRootOut:
-                print '"gdbserver" output:'
-                print ' ' + '\n '.join([s for s in gdbserverRootOut
+            for name, label in self.GDBSERVER_STRATEGIES:
+                if name not in outputs:
+                    continue
+                print '"%s" output:' % label
+                print ' ' + '\n '.join([s for s in outputs[name]
                                         if s]).replace('\0', '')
-            print '"run-as" output:'
-            print ' ' + '\n '.join([s for s in gdbserverRunAsOut
-                                    if s]).replace('\0', '')
-            print '"run-as pkg" output:'
-            print ' ' + '\n '.join([s for s in gdbserverPkgRunAsOut
-                                    if s]).replace('\0', '')
-            print '"su -c" output:'
-            print ' ' + '\n '.join([s for s in gdbserverSuOut
-                                    if s]).replace('\0', '')
-            print '"su -c pkg" output:'
-            print ' ' + '\n '.join([s for s in gdbserverPkgSuOut
-                                    if s]).replace('\0', '')
-            print '"am start" output:'
-            print ' ' + '\n '.join([s for s in gdbserverAmOut
-                                    if s]).replace('\0', '')
-            if any('not executable: magic' in s for s in (
-                    gdbserverRootOut + gdbserverRunAsOut + gdbserverPkgRunAsOut
-                    + gdbserverSuOut + gdbserverPkgSuOut + gdbserverAmOut)):
-                print '\n********'
-                print '* Your device platform is not supported by this GDB'
-                print '* Use jimdb-x86 for x86 targets/devices'
-                print '* Use jimdb-arm for ARM targets/devices'
-                print '********\n'
-            raise gdb.GdbError('failed to run gdbserver')
+        if any('not executable: magic' in s
+               for out in outputs.itervalues() for s in out):
+            print '\n********'
+            print '* Your device platform is not supported by this GDB'
+            print '* Use jimdb-x86 for x86 targets/devices'
+            print '* Use jimdb-arm for ARM targets/devices'
+            print '********\n'
+        raise gdb.GdbError('failed to run gdbserver')
+
+    def _attachGDBServer(self, pkg, filePath, args,
+                         skipShell = False, redirectOut = False,
+                         allowIntent = True):
+        # with warm_attach, attach through a gdbserver in multi-process
+        # mode, which keeps running after gdb exits
+        warm = getattr(self, 'warm_attach', False) and '--attach' in args
+        if warm:
+            pidAttach = args[-1]
+            logPath = cache.path('gdbserver-%s.log' %
+                                 cache.key(adb.getDevice()))
+            # an intent would restart the app instead of attaching to it
+            (gdbserverProc, port, intentPid) = self._startGDBServer(
+                    pkg, ['--multi', args[args.index('--attach') + 1]],
+                    skipShell, logPath=logPath, allowIntent=False)
+            self.port = port
+            self.gdbserver = gdbserverProc
+            adb.forward('tcp:' + port, 'tcp:' + port)
+            print 'Done'
+
+            sys.stdout.write('Setting up remote debugging... ')
+            sys.stdout.flush()
+            gdb.execute('file ' + self.quotePath(filePath), False, True)
+            gdb.execute('target extended-remote :' + port, False, True)
+            gdb.execute('attach ' + pidAttach, False, True)
+            self._saveSession(pkg, pidAttach, port, filePath)
+            print 'Done'
+            return
+
+        (gdbserverProc, port, intentPid) = self._startGDBServer(
+                pkg, args, skipShell, allowIntent=allowIntent)
 
         self.port = port
         self.gdbserver = gdbserverProc
@@ -871,10 +1660,185 @@ class FenInit(gdb.Command):
         sys.stdout.write('Setting up remote debugging... ')
         sys.stdout.flush()
         # load the right file
-        gdb.execute('file ' + filePath, False, True)
+        gdb.execute('file ' + self.quotePath(filePath), False, True)
         gdb.execute('target remote :' + port, False, True)
         print 'Done'
 
+    def _supportsMultiTarget(self, quiet=False):
+        # inferiors connected to different gdbservers need GDB 10 or later
+        m = re.match(r'\d+', gdb.VERSION)
+        if m and int(m.group(0)) >= 10:
+            return True
+        if not quiet:
+            print 'Attaching to multiple processes requires GDB 10 or later.'
+        return False
+
+    def _connectInferior(self, filePath, port, new=True):
+        # connect a new inferior, or the current one, to gdbserver at port;
+        # all inferiors share the sysroot and symbol search paths
+        if new:
+            # 'continue' resumes every inferior, not only the current one
+            gdb.execute('set schedule-multiple on', False, True)
+            gdb.execute('add-inferior -no-connection', False, True)
+            num = max(inf.num for inf in gdb.inferiors())
+            gdb.execute('inferior %d' % num, False, True)
+        gdb.execute('file ' + self.quotePath(filePath), False, True)
+        gdb.execute('target extended-remote :' + port, False, True)
+        return gdb.selected_inferior().num
+
+    def _attachAll(self, pkg, targets):
+        # attach one gdbserver to each of targets, a list of
+        # (pid, file path), and connect each one as an inferior; returns
+        # False if gdbserver cannot attach without restarting the app
+        sys.stdout.write('Attaching to pids %s... ' %
+                         ', '.join(pid for pid, filePath in targets))
+        sys.stdout.flush()
+        gdbserver_port = ':' + str(self.gdbserver_port
+                if hasattr(self, 'gdbserver_port') else 0)
+        # launching gdbserver through an intent restarts the app and
+        # kills the other targets, so only attach directly; the first
+        # gdbserver settles which launch strategy works
+        try:
+            servers = [self._startGDBServer(pkg,
+                    ['--once', '--attach', gdbserver_port, targets[0][0]],
+                    quiet=True, allowIntent=False)]
+        except gdb.GdbError:
+            print '\nCannot attach to multiple processes on this device.'
+            return False
+
+        def start(target):
+            try:
+                return self._startGDBServer(pkg,
+                        ['--once', '--attach', ':0', target[0]],
+                        quiet=True, allowIntent=False)
+            except gdb.GdbError:
+                return (None, None, None)
+        if len(targets) > 1:
+            pool = ThreadPool(len(targets) - 1)
+            try:
+                servers += pool.map(start, targets[1:])
+            finally:
+                pool.close()
+
+        self.gdbservers = []
+        attached = []
+        for (pid, filePath), (proc, port, intentPid) in zip(targets, servers):
+            if not proc:
+                print '\nFailed to run gdbserver for pid %s.' % pid
+                continue
+            self.gdbservers.append(proc)
+            outputThd = threading.Thread(name='GDBServer',
+                                         target=proc.communicate)
+            outputThd.daemon = True
+            outputThd.start()
+            adb.forward('tcp:' + port, 'tcp:' + port)
+            attached.append((pid, filePath, port))
+        self.gdbserver = self.gdbservers[0]
+        self.pid = attached[0][0]
+        self.port = attached[0][2]
+        print 'Done'
+
+        sys.stdout.write('Setting up remote debugging... ')
+        sys.stdout.flush()
+        first = gdb.selected_inferior().num
+        self.inferiors = {}
+        for i, (pid, filePath, port) in enumerate(attached):
+            self.inferiors[pid] = self._connectInferior(filePath, port, i > 0)
+        gdb.execute('inferior %d' % first, False, True)
+        print 'Done'
+        for pid, filePath, port in attached:
+            print '  inferior %d: pid %s' % (self.inferiors[pid], pid)
+        return True
+
+    def _saveSession(self, pkg, pid, port, filePath):
+        # remember a warm session so 'feninit reattach' can reconnect
+        # to it after gdb restarts
+        # the gdbserver we started is the one tracing the attached process
+        out = adb.call(['shell', 'while read -r k v; do '
+                '[ "$k" = TracerPid: ] && echo $v; done < /proc/%s/status' %
+                pid], stderr=subprocess.PIPE).split()
+        serverPid = out[0] if out and out[0].isdigit() and out[0] != '0' \
+                    else None
+        sessions = cache.load('sessions', {})
+        sessions[adb.getDevice()] = {
+            'pkg': pkg,
+            'pid': pid,
+            'port': port,
+            'gdbserverPid': serverPid,
+            'file': filePath,
+            'sysroot': str(gdb.parameter('sysroot')),
+            'solibSearchPath': str(gdb.parameter('solib-search-path')),
+            # used by fastload and later feninit runs
+            'objdir': getattr(self, 'objdir', None),
+            'libdir': getattr(self, 'libdir', None),
+            'bindir': getattr(self, 'bindir', None),
+            'appProcess': getattr(self, '_appProcessName', None),
+        }
+        cache.save('sessions', sessions)
+
+    def _reattach(self):
+        # reconnect to a session saved by _saveSession, without launching
+        # or uploading anything
+        dev = adb.chooseDevice()
+        sessions = cache.load('sessions', {})
+        session = sessions.get(dev)
+        if not session:
+            raise gdb.GdbError('No saved session for device %s; set '
+                    'feninit.default.warm_attach and run feninit first.' % dev)
+
+        sys.stdout.write('Checking session for %s (pid %s)... ' %
+                         (session['pkg'], session['pid']))
+        sys.stdout.flush()
+        out = adb.call(['shell', '[ -d /proc/%s ] && echo target; '
+                '[ -d /proc/%s ] && echo server; true' %
+                (session['pid'], session['gdbserverPid'] or 0)],
+                stderr=subprocess.PIPE).split()
+        error = None
+        if 'target' not in out:
+            error = 'Process %s has exited.' % session['pid']
+        elif session['gdbserverPid'] and 'server' not in out:
+            error = 'gdbserver has exited.'
+        if error:
+            del sessions[dev]
+            cache.save('sessions', sessions)
+            print ''
+            raise gdb.GdbError(error + ' Run feninit to start a new session.')
+        # the forward normally still exists, but the adb server may
+        # have restarted since
+        port = session['port']
+        adb.forward('tcp:' + port, 'tcp:' + port)
+        print 'Done'
+
+        sys.stdout.write('Reconnecting... ')
+        sys.stdout.flush()
+        gdb.execute('set sysroot ' + session['sysroot'], False, True)
+        gdb.execute('set solib-search-path ' + session['solibSearchPath'],
+                    False, True)
+        gdb.execute('handle SIG36 nostop noprint pass', False, True)
+        gdb.execute('file ' + self.quotePath(session['file']), False, True)
+        gdb.execute('target extended-remote :' + port, False, True)
+        gdb.execute('attach ' + session['pid'], False, True)
+        self.device = dev
+        self.pkg = session['pkg']
+        self.pid = session['pid']
+        self.port = port
+        # sessions saved by older versions may not have these
+        for attr, key in (('objdir', 'objdir'), ('libdir', 'libdir'),
+                          ('bindir', 'bindir'),
+                          ('_appProcessName', 'appProcess')):
+            if session.get(key):
+                setattr(self, attr, session[key])
+        print 'Done'
+
+        print '\nReady. Use "continue" to resume execution.'
+
+    def _pushGDBServer(self):
+        # push gdbserver only if the device has a different version
+        gdbserverPath = '/data/local/tmp/gdbserver'
+        adb.pushIfChanged(os.path.join(self.bindir, 'gdbserver'),
+                          gdbserverPath)
+        return gdbserverPath
+
     # returns (env, cmd, args)
     def parseCommand(self, cmd, extra_env=None, extra_args=None, has_cmd=True):
         try:
@@ -903,6 +1867,10 @@ class FenInit(gdb.Command):
             return comps[0] + '=' + pipes.quote(comps[-1])
         return [_quote(s) for s in env]
 
+    def quotePath(self, path):
+        # gdb splits unquoted file arguments on spaces
+        return '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"')
+
     def _chooseCpp(self):
         rootdir = os.path.join(self.objdir, 'dist', 'bin') \
                   if self.objdir else os.getcwd()
@@ -948,40 +1916,41 @@ class FenInit(gdb.Command):
             print '\n' + out
             raise gdb.GdbError('Error while launching %s.' % pkg)
         else:
-            pkgProcs = None
-            while not pkgProcs:
-                pkgProcs = self._getRunningProcs(pkg, waiting=True)
+            watcher = self._watchProcs(pkg)
+            if not watcher.waitFor(watcher.waiting):
+                raise gdb.GdbError('Lost connection to device.')
             # sleep for 2s to allow time to launch
             time.sleep(2)
             print 'Done'
 
-    def _attachCpp(self, pkg):
-        cppPath = '/data/local/tmp/' + os.path.basename(self.cpppath)
-        cppEnv = self.cppenv
-        cppArgs = self.cppargs
+    def _pushCppWrapper(self, pkg, cppEnv):
+        # returns (wrapper path, skipShell); the wrapper sets up the
+        # environment for running tests against the package's libraries
         wrapperPath = '/data/local/tmp/cpptest.run'
         libPath = '/data/data/' + pkg + '/lib'
         cachePath = '/data/data/' + pkg + '/cache'
         profilePath = '/data/data/' + pkg + '/files/mozilla'
 
-        sys.stdout.write('Attaching to test... ')
-        sys.stdout.flush()
-        adb.push(self.cpppath, cppPath)
-        with tempfile.NamedTemporaryFile(delete = False) as f:
-            lines = ['#!/system/bin/sh']
-            lines.extend(['export ' + s for s in cppEnv])
-            lines.append('export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:' +
-                         libPath + ':' + cachePath)
-            lines.append('exec $@')
-            f.write('\n'.join(lines))
-            tmpname = f.name
-        adb.push(tmpname, wrapperPath)
-        adb.call(['shell', 'chmod', '755', wrapperPath])
-        os.remove(tmpname)
+        lines = ['#!/system/bin/sh']
+        lines.extend(['export ' + s for s in cppEnv])
+        lines.append('export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:' +
+                     libPath + ':' + cachePath)
+        lines.append('exec $@')
+        adb.writeIfChanged('\n'.join(lines), wrapperPath)
 
         skipShell = False
         if 'mozilla' not in adb.call(['shell', 'ls', profilePath]):
             skipShell = True
+        return wrapperPath, skipShell
+
+    def _attachCpp(self, pkg):
+        cppPath = '/data/local/tmp/' + os.path.basename(self.cpppath)
+        cppArgs = self.cppargs
+
+        sys.stdout.write('Attaching to test... ')
+        sys.stdout.flush()
+        adb.pushIfChanged(self.cpppath, cppPath)
+        wrapperPath, skipShell = self._pushCppWrapper(pkg, self.cppenv)
 
         gdbserver_port = ':' + str(self.gdbserver_port
                 if hasattr(self, 'gdbserver_port') else 0)
@@ -993,6 +1962,131 @@ class FenInit(gdb.Command):
 
         print '\nReady. Use "continue" to start execution.'
 
+    def _chooseCppBatch(self):
+        rootdir = os.path.join(self.objdir, 'dist', 'bin') \
+                  if self.objdir else os.getcwd()
+        cpppaths = []
+        while not cpppaths:
+            print 'Enter paths of unit tests, separated by spaces'
+            if self.objdir:
+                print '    paths can be relative to $objdir/dist/bin or absolute'
+            print '    wildcards are supported, e.g. Test*'
+            patterns = shlex.split(readinput.call(': ', '-f', '-c', rootdir,
+                                   '--file-mode', '0o100',
+                                   '--file-mode-mask', '0o100'))
+            for pattern in patterns:
+                matches = sorted(glob.glob(os.path.join(rootdir,
+                                 os.path.expanduser(pattern))))
+                cpppaths.extend(os.path.normpath(p) for p in matches
+                                if os.path.isfile(p) and os.access(p, os.X_OK)
+                                and os.path.normpath(p) not in cpppaths)
+            if patterns and not cpppaths:
+                print 'No executable tests found.'
+            print ''
+        self.cpppaths = cpppaths
+        self.cppenv = self.quoteEnv(self.parseCommand(self.cpp_env,
+                has_cmd=False)[0] if hasattr(self, 'cpp_env') and
+                self.cpp_env else [])
+
+    def _runCppBatch(self, pkg):
+        # run tests one after another under one gdbserver in multi-process
+        # mode; stop into gdb only if a test crashes or stops
+        cppPaths = ['/data/local/tmp/' + os.path.basename(p)
+                    for p in self.cpppaths]
+
+        sys.stdout.write('Pushing %d tests... ' % len(cppPaths))
+        sys.stdout.flush()
+        pool = ThreadPool(min(4, len(cppPaths)))
+        try:
+            pool.map(lambda paths: adb.pushIfChanged(*paths),
+                     zip(self.cpppaths, cppPaths))
+        finally:
+            pool.close()
+        wrapperPath, skipShell = self._pushCppWrapper(pkg, self.cppenv)
+        print 'Done'
+
+        sys.stdout.write('Starting gdbserver... ')
+        sys.stdout.flush()
+        gdbserver_port = ':' + str(self.gdbserver_port
+                if hasattr(self, 'gdbserver_port') else 0)
+        (gdbserverProc, port, intentPid) = self._startGDBServer(pkg,
+                ['--multi', '--wrapper', 'sh', wrapperPath, '--',
+                 gdbserver_port], skipShell)
+        self.port = port
+        self.gdbserver = gdbserverProc
+
+        # keep the last lines of test output, to show when a test fails
+        output = collections.deque(maxlen=50)
+        def readOutput():
+            for line in iter(gdbserverProc.stdout.readline, ''):
+                output.append(line.rstrip())
+        outputThd = threading.Thread(name='GDBServer', target=readOutput)
+        outputThd.daemon = True
+        outputThd.start()
+        adb.forward('tcp:' + port, 'tcp:' + port)
+        gdb.execute('target extended-remote :' + port, False, True)
+        print 'Done\n'
+
+        stop = {}
+        def stopped(event):
+            stop['signal'] = getattr(event, 'stop_signal', None)
+        def exited(event):
+            # gdb leaves out exit_code if the exit code is not known
+            stop['exit'] = getattr(event, 'exit_code', None)
+        gdb.events.stop.connect(stopped)
+        gdb.events.exited.connect(exited)
+        results = []
+        try:
+            for localPath, cppPath in zip(self.cpppaths, cppPaths):
+                name = os.path.basename(localPath)
+                sys.stdout.write('%s... ' % name)
+                sys.stdout.flush()
+                stop.clear()
+                output.clear()
+                gdb.execute('file ' + self.quotePath(localPath), False, True)
+                gdb.execute('set remote exec-file ' + cppPath, False, True)
+                start = time.time()
+                runOut = gdb.execute('run', False, True)
+                elapsed = time.time() - start
+                if 'exit' in stop:
+                    code = stop['exit']
+                    result = ('unknown (no exit code)' if code is None else
+                              'pass' if not code else
+                              'fail (exit code %d)' % code)
+                    results.append((name, result, elapsed))
+                    print '%s (%.1fs)' % (result, elapsed)
+                    if result != 'pass' and output:
+                        print '    ' + '\n    '.join(output)
+                    continue
+                # crashed, or stopped at a breakpoint or by Ctrl+C
+                signal = stop.get('signal')
+                result = ('interrupted' if signal == 'SIGINT' else
+                          'crash (%s)' % signal if signal else 'stopped')
+                results.append((name, result, elapsed))
+                print '%s (%.1fs)\n' % (result, elapsed)
+                print runOut.rstrip()
+                break
+        finally:
+            gdb.events.stop.disconnect(stopped)
+            gdb.events.exited.disconnect(exited)
+
+        print '\nSummary:'
+        for name, result, elapsed in results:
+            print '  %-40s %-24s %6.1fs' % (name, result, elapsed)
+        skipped = len(cppPaths) - len(results)
+        passed = len([r for r in results if r[1] == 'pass'])
+        unknown = len([r for r in results if r[1].startswith('unknown')])
+        print '%d passed, %d failed, %d unknown, %d not run' % (
+                passed, len(results) - passed - unknown, unknown, skipped)
+        if 'exit' in stop:
+            # the last test exited, so all tests ran to completion
+            gdb.execute('disconnect', False, True)
+            gdbserverProc.terminate()
+            self.gdbserver = None
+        else:
+            print '\nStopped in %s. Use "continue" to resume execution.' % \
+                  results[-1][0]
+
     def _getTopSrcDir(self, objdir):
         if objdir:
             mkname = os.path.join(objdir, 'Makefile')
@@ -1088,12 +2182,14 @@ class FenInit(gdb.Command):
                             'update now? [yes/no]: ' %
                             ((time.time() - os.path.getmtime(xreupdate))
                                 / 60 / 60 / 24),
-                            '-l', str(['yes', 'no']))
+                            '-l', ['yes', 'no'])
                     print ''
                     if ans[0] == 'y' or ans[0] == 'Y':
                         shutil.rmtree(xredatadir, ignore_errors=True)
                         getxre.call(xredatadir, self.mochi_xre_url
                                     if hasattr(self, 'mochi_xre_url')
+                                    else None, self.mochi_xre_server
+                                    if hasattr(self, 'mochi_xre_server')
                                     else None)
                     # update timestamp regardless of choice above
                     touchUpdate()
@@ -1105,6 +2201,8 @@ class FenInit(gdb.Command):
             if not xredir:
                 getxre.call(xredatadir, self.mochi_xre_url
                                         if hasattr(self, 'mochi_xre_url')
+                                        else None, self.mochi_xre_server
+                                        if hasattr(self, 'mochi_xre_server')
                                         else None)
                 touchUpdate()
                 xredir = xredatadir
@@ -1164,6 +2262,15 @@ class FenInit(gdb.Command):
                     topsrcdir = test[0: testsidx + len(testsdir)]
                 else:
                     topsrcdir = os.path.join(harness, 'tests')
+            if harness == os.path.normpath(os.path.join(xredir,
+                    os.path.pardir, 'mochitest')):
+                # tests in the downloaded harness are extracted on demand
+                testdir = os.path.relpath(test, topsrcdir) if test else ''
+                if os.path.splitext(testdir)[1]:
+                    testdir = os.path.dirname(testdir)
+                testdir = testdir.replace(os.path.sep, '/').strip('/')
+                getxre.fetch(os.path.dirname(harness), 'mochitest/tests/' +
+                             (testdir + '/' if testdir else ''))
             exe = [sys.executable, os.path.join(harness, script),
                    '--autorun', '--close-when-done', '--deviceIP=',
                    '--console-level=INFO', '--file-level=INFO',
@@ -1185,8 +2292,10 @@ class FenInit(gdb.Command):
                                 stderr=subprocess.STDOUT,
                                 preexec_fn=exePreExec, env=env)
 
+        results = mochitest.MochitestParser()
         line = proc.stdout.readline()
         while line and proc.poll() == None:
+            results.feed(line)
             print '\x1B[1mout> \x1B[22m' + line.strip()
             if 'INFO' in line and 'application pid' in line.lower():
                 time.sleep(2)
@@ -1198,29 +2307,9 @@ class FenInit(gdb.Command):
             raise gdb.GdbError('Test harness exited '
                                'without launching Fennec.')
 
-        # collect further output in another thread
-        def makeOutputWait(obj, proc):
-            def outputWait():
-                while proc.poll() == None:
-                    line = proc.stdout.readline()
-                    if not line:
-                        break
-                    if 'INFO' in line and \
-                        ('TEST-PASS' in line or 'TEST-KNOWN-FAIL' in line):
-                        # don't log passing tests
-                        continue
-                    if line.startswith('----') and '/dev/log' in line:
-                        # start of log dump
-                        proc.communicate()
-                        break
-                    if adblog.continuing:
-                        sys.__stderr__.write('\x1B[1mout> \x1B[22m' + line)
-            return outputWait
-        outThd = threading.Thread(
-                name = 'Mochitest',
-                target = makeOutputWait(self, proc))
-        outThd.daemon = True
-        outThd.start()
+        # parse further output in another thread
+        mochitest.start(proc, results,
+                        getattr(self, 'mochi_break_on_failure', False))
         return proc
 
     def _choosePid(self):
@@ -1231,22 +2320,51 @@ class FenInit(gdb.Command):
         return readinput.call('Enter package (e.g., org.mozilla.geckoview_example): ')
 
     def invoke(self, argument, from_tty):
+        # prepare and switch do not debug anything, so they skip the
+        # pagination and prompt helper setup below
+        args = argument.split()
+        if args[:1] == ['prepare']:
+            self.dont_repeat()
+            self._prepare(args[1:])
+            return
+        if args[:1] == ['switch']:
+            self.dont_repeat()
+            if len(args) != 2:
+                raise gdb.GdbError('Usage: feninit switch SERIAL')
+            self._switch(args[1])
+            return
         try:
             saved_height = gdb.parameter('height')
             saved_height = int(saved_height) if saved_height else 0
             gdb.execute('set height 0') # suppress pagination
+            # start the prompt helper while we talk to the device
+            readinput.start()
             if hasattr(self, 'gdbserver') and self.gdbserver:
                 if self.gdbserver.poll() is None:
                     print 'Already in remote debug mode.'
                     return
                 delattr(self, 'gdbserver')
+            self.gdbservers = []
+            self.inferiors = {}
+            self._stopFollowing()
             if hasattr(self, '_mochitest') and self._mochitest:
                 if self._mochitest.poll() is None:
                     print 'Already in remote Mochitest mode.'
                     return
                 delattr(self, '_mochitest')
+            if argument.strip() == 'reattach':
+                self._reattach()
+                self.dont_repeat()
+                return
             self._task = self._chooseTask()
+            if self._task == self.TASK_REATTACH:
+                self._reattach()
+                self.dont_repeat()
+                return
             self._chooseDevice()
+            self._newInferiorIfBusy()
+            self._setLibDirs()
+            self._startPhases()
             self._chooseObjdir()
             self._pullLibsAndSetPaths()
 
@@ -1254,6 +2372,7 @@ class FenInit(gdb.Command):
             objdir = self.objdir
             pkg = self._getPackageName(objdir,
                 webapps=(self._task in (self.TASK_FENNEC, self.TASK_JAVA)))
+            self.pkg = pkg
             self._verifyPackage(objdir, pkg)
 
             if not objdir and pkg:
@@ -1284,13 +2403,19 @@ class FenInit(gdb.Command):
                 self._chooseCpp()
                 self._prepareCpp(pkg)
                 self._attachCpp(pkg)
+            elif self._task == self.TASK_CPP_BATCH:
+                self._chooseCppBatch()
+                self._prepareCpp(pkg)
+                self._runCppBatch(pkg)
             elif self._task == self.TASK_ATTACH_PID:
                 pid = self._choosePid()
                 self._attachPid(pkg, pid)
             elif self._task == self.TASK_ATTACH_PACKAGE:
                 pkg = self._choosePackage()
+                self.pkg = pkg
                 self._attach(pkg, False)
 
+            self._session(self.device).save(self)
             self.dont_repeat()
         except:
             # if there is an error, a gdbserver might be left hanging
@@ -1299,6 +2424,10 @@ class FenInit(gdb.Command):
                     self.gdbserver.terminate()
                     print 'Terminated gdbserver.'
                 delattr(self, 'gdbserver')
+            for proc in getattr(self, 'gdbservers', []):
+                if proc.poll() is None:
+                    proc.terminate()
+            self.gdbservers = []
             if hasattr(self, '_mochitest') and self._mochitest:
                 if self._mochitest.poll() is None:
                     self._mochitest.terminate()
@@ -1306,7 +2435,10 @@ class FenInit(gdb.Command):
                 delattr(self, '_mochitest')
             raise
         finally:
+            self._stopPhases()
+            self._stopWatcher()
             gdb.execute('set height ' + str(saved_height), False, False)
 
 default = FenInit()
+lazy.bind(__name__, default)
 
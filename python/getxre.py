@@ -7,12 +7,17 @@ import sys, os, subprocess
 
 if __name__ == '__main__': # not module
 
-    import ftplib, zipfile, platform, shutil
+    import ftplib, urllib2, urlparse, posixpath, zipfile, platform, shutil
+    import threading, hashlib, re, time, json
     from optparse import OptionParser
 
     parser = OptionParser()
     parser.add_option('-d', dest='d')
     parser.add_option('-u', dest='u')
+    parser.add_option('-s', dest='s')
+    parser.add_option('-c', dest='c')
+    parser.add_option('-j', dest='j', type='int')
+    parser.add_option('-f', dest='f', action='append')
     (args, extras) = parser.parse_args()
 
     if not hasattr(args, 'd') or not args.d:
@@ -33,59 +38,441 @@ if __name__ == '__main__': # not module
     else:
         print 'Platform not supported.\n'
         exit(1)
+    # build info file next to the archives; the first line is the build ID
+    infoname = binname.split('.')[0] + '.txt'
+    checksumsname = binname.split('.')[0] + '.checksums'
 
-    def download(src, dst):
+    BLOCK_SIZE = 64 * 1024
+    # do not split downloads into chunks smaller than this
+    MIN_CHUNK_SIZE = 4 * 1024 * 1024
+    # number of builds kept in the archive cache
+    CACHE_BUILDS = 2
+
+    class FTPServer(object):
+        '''Files on an FTP server; ranges are read using REST'''
+
+        def __init__(self, host):
+            self.host = host
+
+        def _connect(self):
+            ftp = ftplib.FTP(self.host)
+            ftp.login()
+            ftp.voidcmd('TYPE I')
+            return ftp
+
+        def list(self, path):
+            ftp = self._connect()
+            try:
+                return ftp.nlst(path)
+            finally:
+                ftp.quit()
+
+        def size(self, path):
+            ftp = self._connect()
+            try:
+                return ftp.size(path)
+            finally:
+                ftp.quit()
+
+        def hasRanges(self, path):
+            return True
+
+        def read(self, path, offset, length, write):
+            '''Call write() with length bytes of path starting at offset'''
+            ftp = self._connect()
+            try:
+                conn = ftp.transfercmd('RETR ' + path, rest=offset or None)
+                try:
+                    while length > 0:
+                        data = conn.recv(min(BLOCK_SIZE, length))
+                        if not data:
+                            break
+                        write(data)
+                        length -= len(data)
+                finally:
+                    conn.close()
+            finally:
+                # the transfer may be cut short; don't wait for its reply
+                ftp.close()
+
+    class HTTPServer(object):
+        '''Files on an HTTP server; ranges are read using Range headers,
+        and directories are listed by the links in their index pages'''
+
+        def __init__(self, url):
+            self.url = url.rstrip('/')
+
+        def _open(self, path, headers={}, method=None):
+            request = urllib2.Request(self.url + path, headers=headers)
+            if method:
+                request.get_method = lambda: method
+            return urllib2.urlopen(request)
+
+        def list(self, path):
+            path = path.rstrip('/') + '/'
+            page = self._open(path).read()
+            names = set(posixpath.basename(urlparse.urlparse(link).path)
+                        for link in re.findall(r'href="([^"]+)"', page)
+                        if not link.endswith('/'))
+            return [path + urllib2.unquote(n) for n in sorted(names) if n]
+
+        def size(self, path):
+            return int(self._open(path, method='HEAD')
+                           .info().getheader('Content-Length'))
+
+        def hasRanges(self, path):
+            # e.g. SimpleHTTPServer always sends the whole file
+            return 'bytes' in (self._open(path, method='HEAD')
+                               .info().getheader('Accept-Ranges') or '')
+
+        def read(self, path, offset, length, write):
+            '''Call write() with length bytes of path starting at offset'''
+            resp = self._open(path, {'Range': 'bytes=%d-%d' %
+                                     (offset, offset + length - 1)})
+            try:
+                if offset and resp.getcode() != 206:
+                    raise IOError('%s does not support ranges' % self.url)
+                while length > 0:
+                    data = resp.read(min(BLOCK_SIZE, length))
+                    if not data:
+                        break
+                    write(data)
+                    length -= len(data)
+            finally:
+                resp.close()
+
+    def getServer(url):
+        '''Return server for url; a plain host name means FTP'''
+        if '://' not in url:
+            return FTPServer(url)
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme == 'ftp':
+            return FTPServer(parsed.netloc)
+        if parsed.scheme in ('http', 'https'):
+            return HTTPServer(url)
+        print 'Unsupported server %s.' % url
+        exit(1)
+
+    def readAll(src):
+        data = []
+        server.read(src, 0, server.size(src), data.append)
+        return ''.join(data)
+
+    def download(src, dst, size, jobs, sink=None):
+        '''Download src to dst in up to jobs parallel chunks. Chunks are
+        kept in dst.partN files until done, so a download that is
+        interrupted resumes where it left off. If sink is given, the
+        downloaded data is written to it in order as it arrives.'''
         bn = os.path.basename(dst)
-        with open(dst, 'wb') as f:
-            size = [0, 0, ftp.size(src)]
-            def write(s):
-                f.write(s)
-                size[0] += len(s)
-                if size[1] > 0 and size[0] - size[1] < size[2] / 100:
-                    return
-                size[1] = size[0]
-                sys.stdout.write('\rDownloading %s... %d%% ' %
-                                 (bn, size[1] * 100 / size[2]))
-                sys.stdout.flush()
-            ftp.retrbinary('RETR ' + src, write)
+        if not server.hasRanges(src):
+            # cannot resume or split the download
+            jobs = 1
+            if os.path.isfile(dst + '.part0'):
+                os.remove(dst + '.part0')
+        chunk = max(MIN_CHUNK_SIZE, -(-size // jobs))
+        ranges = [(start, min(chunk, size - start))
+                  for start in range(0, size, chunk)] or [(0, 0)]
+        parts = ['%s.part%d' % (dst, i) for i in range(len(ranges))]
+        done = [0] * len(ranges)
+        errors = []
+
+        def fetch(i):
+            start, length = ranges[i]
+            try:
+                have = (os.path.getsize(parts[i])
+                        if os.path.isfile(parts[i]) else 0)
+                if have > length:
+                    # left over from a different chunk layout
+                    os.remove(parts[i])
+                    have = 0
+                done[i] = have
+                if have < length:
+                    # unbuffered, so feed() can read what is counted
+                    with open(parts[i], 'ab', 0) as f:
+                        def write(data):
+                            f.write(data)
+                            done[i] += len(data)
+                        server.read(src, start + have, length - have, write)
+                if done[i] != length:
+                    raise IOError('download of %s was cut short' % bn)
+            except Exception, e:
+                errors.append(e)
+
+        def feed():
+            try:
+                for i, part in enumerate(parts):
+                    pos = 0
+                    while pos < ranges[i][1]:
+                        if done[i] > pos:
+                            with open(part, 'rb') as f:
+                                f.seek(pos)
+                                data = f.read(min(done[i] - pos,
+                                                  16 * BLOCK_SIZE))
+                            sink.write(data)
+                            pos += len(data)
+                        elif errors:
+                            return
+                        else:
+                            time.sleep(0.05)
+            except IOError:
+                # the consumer exited; it reports its own error
+                pass
+
+        threads = [threading.Thread(target=fetch, args=(i,))
+                   for i in range(len(ranges))]
+        if sink:
+            threads.append(threading.Thread(target=feed))
+        for t in threads:
+            t.daemon = True
+            t.start()
+        while any(t.is_alive() for t in threads):
+            sys.stdout.write('\rDownloading %s... %d%% ' %
+                             (bn, sum(done) * 100 / max(size, 1)))
+            sys.stdout.flush()
+            time.sleep(0.2)
+        if errors:
+            print 'Failed'
+            print '%s (run again to resume)' % errors[0]
+            exit(1)
+        with open(dst + '.tmp', 'wb') as out:
+            for part in parts:
+                with open(part, 'rb') as f:
+                    shutil.copyfileobj(f, out, BLOCK_SIZE)
+        os.rename(dst + '.tmp', dst)
+        for part in parts:
+            os.remove(part)
         print '\rDownloading %s... Done' % bn
 
-    server = 'ftp.mozilla.org'
-    sys.stdout.write('Connecting to %s... ' % server)
-    sys.stdout.flush()
-    ftp = ftplib.FTP(server)
-    try:
-        ftp.login()
-        files = ftp.nlst(args.u if hasattr(args, 'u') and args.u else
-                         '/pub/mozilla.org/firefox/nightly/latest-mozilla-aurora')
-        print 'Done'
+    def parseChecksums(data):
+        '''Return {file name: (hash type, size, digest)} from a
+        .checksums file, which has "digest type size name" lines'''
+        checksums = {}
+        for line in data.splitlines():
+            cols = line.split()
+            if len(cols) == 4 and cols[2].isdigit():
+                checksums[posixpath.basename(cols[3])] = (
+                        cols[1], int(cols[2]), cols[0].lower())
+        return checksums
 
+    def verify(path, checksums):
+        '''Check file against its entry in checksums, if there is one'''
+        entry = checksums.get(os.path.basename(path))
+        if not entry:
+            return True
+        algorithm, size, digest = entry
+        if os.path.getsize(path) != size:
+            return False
         try:
-            binsrc = next(f for f in files if binname in f)
-        except StopIteration:
-            print 'Cannot find binary archive %s.' % binname
+            h = hashlib.new(algorithm)
+        except ValueError:
+            return True
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(BLOCK_SIZE), ''):
+                h.update(data)
+        return h.hexdigest() == digest
+
+    class RemoteFile(object):
+        '''Read-only file on a server that supports ranges, for zipfile;
+        reads ahead, so neighboring zip members take one request'''
+
+        READ_AHEAD = 1024 * 1024
+
+        def __init__(self, path, size):
+            self.name = path
+            self.size = size
+            self.pos = 0
+            self.buf = ''
+            self.bufpos = 0
+
+        def seek(self, offset, whence=0):
+            if whence == 1:
+                offset += self.pos
+            elif whence == 2:
+                offset += self.size
+            self.pos = offset
+
+        def tell(self):
+            return self.pos
+
+        def read(self, n=-1):
+            if n < 0:
+                n = self.size - self.pos
+            n = max(0, min(n, self.size - self.pos))
+            if self.pos < self.bufpos or \
+                    self.pos + n > self.bufpos + len(self.buf):
+                data = []
+                server.read(self.name, self.pos,
+                            min(max(n, self.READ_AHEAD),
+                                self.size - self.pos), data.append)
+                self.buf = ''.join(data)
+                self.bufpos = self.pos
+            start = self.pos - self.bufpos
+            data = self.buf[start: start + n]
+            self.pos += len(data)
+            return data
+
+        def close(self):
+            self.buf = ''
+
+    def fetch(src, builddir, checksums, sink=None):
+        '''Return the path of src in the archive cache, downloading it
+        unless a verified copy is already there; sink, if given, is passed
+        the contents of src as they arrive'''
+        dst = os.path.join(builddir, posixpath.basename(src))
+        if os.path.isfile(dst) and verify(dst, checksums):
+            print 'Using cached %s' % os.path.basename(dst)
+            if sink:
+                with open(dst, 'rb') as f:
+                    try:
+                        shutil.copyfileobj(f, sink, BLOCK_SIZE)
+                    except IOError:
+                        pass
+            return dst
+        download(src, dst, server.size(src), args.j or 4, sink)
+        sys.stdout.write('Verifying %s... ' % os.path.basename(dst))
+        sys.stdout.flush()
+        if not verify(dst, checksums):
+            os.remove(dst)
+            print 'Checksum mismatch'
             exit(1)
-        bindst = os.path.join(xredir, binsrc.split('/')[-1])
-        download(binsrc, bindst)
-        try:
-            testsrc = next(f for f in files if testname in f)
-        except StopIteration:
-            print 'Cannot find tests archive %s.' % testname
+        print 'Done'
+        return dst
+
+    def pruneCache(cachedir, keep):
+        builds = sorted((os.path.getmtime(os.path.join(cachedir, d)), d)
+                        for d in os.listdir(cachedir)
+                        if os.path.isdir(os.path.join(cachedir, d)))
+        for mtime, d in builds[: -keep]:
+            shutil.rmtree(os.path.join(cachedir, d), ignore_errors=True)
+
+    # parts of the tests archive needed to run the harness
+    TEST_PREFIXES = ['bin/', 'certs/', 'mochitest/', 'modules/', 'mozbase/']
+    # the tests themselves are only extracted on demand, except for
+    # the harness support files that live next to them
+    ON_DEMAND_PREFIX = 'mochitest/tests/'
+    TEST_SUPPORT_PREFIXES = ['mochitest/tests/SimpleTest/',
+                             'mochitest/tests/testing/']
+    # where to find the tests archive for extracting on demand
+    TEST_INDEX = '.tests.json'
+
+    def needed(name):
+        if not any(name.startswith(p) for p in TEST_PREFIXES):
+            return False
+        return not name.startswith(ON_DEMAND_PREFIX) or \
+               any(name.startswith(p) for p in TEST_SUPPORT_PREFIXES)
+
+    def openTests(index):
+        if index.get('path') and os.path.isfile(index['path']):
+            return zipfile.ZipFile(index['path'], 'r')
+        return zipfile.ZipFile(RemoteFile(index['src'], index['size']), 'r')
+
+    def extractTests(testzip, wanted):
+        '''Extract wanted members that are not extracted yet, in archive
+        order; return the number of files extracted'''
+        if any(not os.path.realpath(os.path.join(xredir, f)).startswith(
+               os.path.realpath(xredir))
+               for f in testzip.namelist()):
+            # extracted file will be outside of the destination directory
+            print 'Invalid zip file.\n'
             exit(1)
-        testdst = os.path.join(xredir, testsrc.split('/')[-1])
-        download(testsrc, testdst)
-    finally:
-        ftp.quit()
+        members = sorted((m for m in testzip.infolist() if wanted(m.filename)
+                          and not os.path.exists(
+                              os.path.join(xredir, m.filename))),
+                         key=lambda m: m.header_offset)
+        for member in members:
+            testzip.extract(member, xredir)
+        return len([m for m in members if not m.filename.endswith('/')])
 
-    sys.stdout.write('Extracting %s... ' % os.path.basename(bindst))
+    if args.f:
+        # extract tests on demand
+        try:
+            with open(os.path.join(xredir, TEST_INDEX), 'r') as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            # not extracted by us; nothing to fetch
+            exit(0)
+        server = getServer(index['server'])
+        sys.stdout.write('Extracting %s... ' % ', '.join(args.f))
+        sys.stdout.flush()
+        testzip = openTests(index)
+        try:
+            count = extractTests(testzip, lambda name:
+                    any(name.startswith(p) for p in args.f))
+        finally:
+            testzip.close()
+        print 'Done (%d files)' % count
+        exit(0)
+
+    serverurl = args.s or 'ftp.mozilla.org'
+    sys.stdout.write('Connecting to %s... ' % serverurl)
     sys.stdout.flush()
+    server = getServer(serverurl)
+    files = server.list(args.u if hasattr(args, 'u') and args.u else
+                        '/pub/mozilla.org/firefox/nightly/latest-mozilla-aurora')
+    print 'Done'
+
+    try:
+        binsrc = next(f for f in files if binname in f)
+    except StopIteration:
+        print 'Cannot find binary archive %s.' % binname
+        exit(1)
+    try:
+        testsrc = next(f for f in files if testname in f)
+    except StopIteration:
+        print 'Cannot find tests archive %s.' % testname
+        exit(1)
+
+    # archives are cached by build ID, or by archive name if the build
+    # info is missing; a build directory has the same file names as the
+    # server directory, so it can be served to other machines as is
+    infosrc = next((f for f in files if f.endswith(infoname)), None)
+    info = readAll(infosrc) if infosrc else ''
+    buildid = info.split()[0] if info.split() else \
+              posixpath.basename(binsrc).split(binname)[0].rstrip('.')
+    buildid = re.sub(r'[^\w.-]', '_', buildid)
+    checksumsrc = next((f for f in files if f.endswith(checksumsname)), None)
+    checksumdata = readAll(checksumsrc) if checksumsrc else ''
+    checksums = parseChecksums(checksumdata)
+
+    cachedir = os.path.abspath(args.c or os.path.join(xredir, os.pardir,
+                                                      'cache', 'xre'))
+    builddir = os.path.join(cachedir, buildid)
+    if not os.path.isdir(builddir):
+        os.makedirs(builddir)
+    os.utime(builddir, None)
+    for src, data in ((infosrc, info), (checksumsrc, checksumdata)):
+        if src:
+            with open(os.path.join(builddir, posixpath.basename(src)),
+                      'wb') as f:
+                f.write(data)
+
     bindir = os.path.join(xredir, 'bin')
     if platform.system() == 'Linux':
+        # extract while downloading
         if not os.path.isdir(bindir):
             os.makedirs(os.path.abspath(bindir))
-        subprocess.check_call(['tar', '--strip-components=1',
-                               '-xjf', bindst, '-C', bindir])
+        tar = subprocess.Popen(['tar', '--strip-components=1',
+                                '-xjf', '-', '-C', bindir],
+                               stdin=subprocess.PIPE)
+        try:
+            bindst = fetch(binsrc, builddir, checksums, tar.stdin)
+        except:
+            tar.stdin.close()
+            tar.wait()
+            # don't leave a partial XRE that looks complete
+            shutil.rmtree(bindir, ignore_errors=True)
+            raise
+        sys.stdout.write('Extracting %s... ' % os.path.basename(bindst))
+        sys.stdout.flush()
+        tar.stdin.close()
+        if tar.wait() != 0:
+            shutil.rmtree(bindir, ignore_errors=True)
+            print 'Failed'
+            exit(1)
     elif platform.system() == 'Darwin':
+        bindst = fetch(binsrc, builddir, checksums)
+        sys.stdout.write('Extracting %s... ' % os.path.basename(bindst))
+        sys.stdout.flush()
         out = subprocess.check_output(['hdiutil', 'attach',
                     '-nobrowse', bindst]).splitlines()
         try:
@@ -103,22 +490,27 @@ if __name__ == '__main__': # not module
     else:
         print 'Platform not supported.\n'
         exit(1)
-    os.remove(bindst)
     print 'Done'
-    sys.stdout.write('Extracting %s... ' % os.path.basename(testdst))
+
+    # the tests archive is read in place if the server supports ranges,
+    # and only the needed members are transferred
+    index = {'server': serverurl, 'src': testsrc,
+             'size': server.size(testsrc), 'path': None}
+    testdst = os.path.join(builddir, posixpath.basename(testsrc))
+    if (os.path.isfile(testdst) and verify(testdst, checksums)) or \
+            not server.hasRanges(testsrc):
+        index['path'] = fetch(testsrc, builddir, checksums)
+    pruneCache(cachedir, CACHE_BUILDS)
+
+    sys.stdout.write('Extracting %s... ' % posixpath.basename(testsrc))
     sys.stdout.flush()
-    testzip = zipfile.ZipFile(testdst, 'r')
+    testzip = openTests(index)
     try:
-        if any(not os.path.realpath(os.path.join(xredir, f)).startswith(
-               os.path.realpath(xredir))
-               for f in testzip.namelist()):
-            # extracted file will be outside of the destination directory
-            print 'Invalid zip file.\n'
-            exit(1)
-        testzip.extractall(xredir)
+        extractTests(testzip, needed)
     finally:
         testzip.close()
-    os.remove(testdst)
+    with open(os.path.join(xredir, TEST_INDEX), 'w') as f:
+        json.dump(index, f)
     print 'Done'
     for binary_name in ['certutil', 'pk12util', 'xpcshell', 'ssltunnel']:
         binary_path = os.path.join(xredir, 'bin', binary_name)
@@ -130,13 +522,15 @@ if __name__ == '__main__': # not module
 
 else:
 
-    import gdb
+    import gdb, cache
 
-    def call(xredir, url=None):
+    def call(xredir, url=None, server=None):
         cmd = [sys.executable, os.path.join(gdb.PYTHONDIR, 'getxre.py'),
-                '-d', xredir]
+                '-d', xredir, '-c', cache.path('xre', '')]
         if url:
             cmd.extend(['-u', url])
+        if server:
+            cmd.extend(['-s', server])
         try:
             proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
             out = proc.communicate()[1]
@@ -147,3 +541,16 @@ else:
                                 str(proc.returncode))
         return out
 
+    def fetch(xredir, *prefixes):
+        '''Extract members under prefixes from the tests archive, if
+        xredir was set up by call() and they are not extracted yet'''
+        cmd = [sys.executable, os.path.join(gdb.PYTHONDIR, 'getxre.py'),
+                '-d', xredir]
+        for prefix in prefixes:
+            cmd.extend(['-f', prefix])
+        try:
+            ret = subprocess.call(cmd)
+        except OSError, e:
+            raise gdb.GdbError('cannot run getxre: ' + str(e))
+        if ret != 0:
+            raise gdb.GdbError('getxre returned exit code ' + str(ret))
@@ -0,0 +1,147 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Register commands that import their modules on first use
+
+gdbinit imports this module instead of feninit, tracebt, fastload, adblog,
+updater, and mochitest. Settings such as "feninit.default.objdir = ..." in
+gdbinit.local are recorded, and applied by the module when it is loaded.'''
+
+import gdb, sys, importlib, collections
+
+# stand-ins by module name, until the module is loaded
+_modules = {}
+# keep stubs alive after the real commands replace them
+_stubs = []
+
+class Settings(object):
+    '''Record attributes set on a module's default object before the
+    module is loaded; forward them to the real object afterwards'''
+
+    def __init__(self):
+        self.__dict__['_values'] = collections.OrderedDict()
+        self.__dict__['_target'] = None
+
+    def __getattr__(self, name):
+        if self._target is not None:
+            return getattr(self._target, name)
+        if name in self._values:
+            return self._values[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if self._target is not None:
+            setattr(self._target, name, value)
+        else:
+            self._values[name] = value
+
+class LazyModule(object):
+    '''Stand-in for a module name in gdb's Python namespace
+
+    Setting members of "default" is recorded; anything else imports the
+    module right away.'''
+
+    def __init__(self, name, hasDefault):
+        self.__dict__['_name'] = name
+        if hasDefault:
+            self.__dict__['default'] = Settings()
+
+    def __getattr__(self, name):
+        return getattr(importlib.import_module(self._name), name)
+
+    def __setattr__(self, name, value):
+        setattr(importlib.import_module(self._name), name, value)
+
+def bind(name, default):
+    '''Called by module name when it creates its default object; applies
+    the settings recorded before the module was loaded'''
+    lazy = _modules.pop(name, None)
+    if not lazy:
+        return
+    settings = lazy.__dict__['default']
+    for attr, value in settings._values.iteritems():
+        setattr(default, attr, value)
+    settings.__dict__['_target'] = default
+    main = sys.modules['__main__']
+    if getattr(main, name, None) is lazy:
+        setattr(main, name, sys.modules[name])
+
+def module(name, hasDefault=True):
+    '''Make name in gdb's Python namespace a stand-in for the module'''
+    main = sys.modules['__main__']
+    if name in sys.modules:
+        setattr(main, name, sys.modules[name])
+    else:
+        _modules[name] = LazyModule(name, hasDefault)
+        setattr(main, name, _modules[name])
+    return getattr(main, name)
+
+def setting(name, attr, default=None):
+    '''Return a setting of module name, without loading the module'''
+    obj = getattr(sys.modules['__main__'], name).default
+    return getattr(obj, attr, default)
+
+class LazyCommand(gdb.Command):
+    '''Stub for a command that imports its module when first run
+
+    Importing the module registers the real command in place of the
+    stub. If attr is given, the real command is module.attr and is called
+    directly; otherwise the command line is run again, which also works
+    for prefix commands.'''
+
+    def __init__(self, name, module, attr=None,
+                 command_class=gdb.COMMAND_SUPPORT):
+        super(LazyCommand, self).__init__(name, command_class)
+        self._name = name
+        self._module = module
+        self._attr = attr
+        _stubs.append(self)
+
+    def _load(self):
+        module = importlib.import_module(self._module)
+        return getattr(module, self._attr) if self._attr else None
+
+    def complete(self, text, word):
+        command = self._load()
+        if not command:
+            return gdb.COMPLETE_NONE
+        return command.complete(text, word)
+
+    def invoke(self, argument, from_tty):
+        command = self._load()
+        if command:
+            return command.invoke(argument, from_tty)
+        gdb.execute(self._name + ' ' + argument, from_tty)
+
+def event(registry, name, handler):
+    '''Import module name on the first event from registry, and pass the
+    event to its handler; the module connects its own handlers on import'''
+    def firstEvent(event):
+        registry.disconnect(firstEvent)
+        if name in sys.modules:
+            # already imported, so its own handler got the event
+            return
+        getattr(importlib.import_module(name), handler)(event)
+    registry.connect(firstEvent)
+
+def register():
+    '''Register the stand-ins and command stubs; called from gdbinit'''
+    # module names used in gdbinit and gdbinit.local
+    for name in ('feninit', 'tracebt', 'fastload', 'updater'):
+        module(name)
+    for name in ('adblog', 'mochitest'):
+        module(name, hasDefault=False)
+
+    # commands, by the modules that define them
+    LazyCommand('feninit', 'feninit', 'default')
+    LazyCommand('tracebt', 'tracebt', 'default', gdb.COMMAND_STACK)
+    LazyCommand('fastload', 'fastload', 'default')
+    LazyCommand('update-gdbutils', 'updater', 'default')
+    LazyCommand('adb-log', 'adblog')
+    LazyCommand('show adb-log-stats', 'adblog')
+    LazyCommand('mochitest', 'mochitest')
+
+    # adblog starts reading logcat when the program first continues
+    event(gdb.events.cont, 'adblog', 'cont_handler')
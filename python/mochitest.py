@@ -0,0 +1,213 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gdb, adblog
+import threading, sys, time, re, collections
+
+# kind is 'start', 'pass', 'todo', 'fail', 'end', 'info', 'log-start',
+# 'log-end', or 'output' for lines that are not test results
+MochitestEvent = collections.namedtuple('MochitestEvent',
+        ['kind', 'test', 'status', 'message', 'line'])
+
+class TestResult(object):
+    '''Results of one test file'''
+
+    # failure messages kept per test
+    MAX_FAILURES = 10
+
+    def __init__(self, name):
+        self.name = name
+        self.passed = 0
+        self.todo = 0
+        self.failed = 0
+        self.failures = []
+        self.start = time.time()
+        self.duration = None
+
+    def __str__(self):
+        state = ('%.1fs' % self.duration if self.duration is not None
+                 else 'running')
+        return '%s: %d passed, %d failed, %d todo (%s)' % (
+                self.name, self.passed, self.failed, self.todo, state)
+
+class MochitestParser(object):
+    '''Parse harness output into MochitestEvents, one line at a time
+
+    Memory use is bounded: only counters, the most recent test results,
+    and a limited number of failure messages are kept.'''
+
+    # e.g. '12 INFO TEST-UNEXPECTED-FAIL | /tests/test_foo.html | message'
+    RESULT_RE = re.compile(r'\b(TEST-[A-Z-]+) \| ([^|]*?)\s*(?:\| (.*))?$')
+    # test results kept for "mochitest status"
+    MAX_RESULTS = 1000
+
+    def __init__(self):
+        self.results = collections.OrderedDict()
+        self.current = None
+        self.tests = 0
+        self.passed = 0
+        self.todo = 0
+        self.failed = 0
+        self.logLines = 0
+        self.inLogDump = False
+        self.lock = threading.Lock()
+
+    def _result(self, name):
+        result = self.results.get(name)
+        if not result:
+            result = TestResult(name)
+            self.results[name] = result
+            if len(self.results) > self.MAX_RESULTS:
+                self.results.popitem(last=False)
+        return result
+
+    def feed(self, line):
+        '''Parse one line of output and return its event'''
+        line = line.rstrip('\r\n')
+        with self.lock:
+            match = self.RESULT_RE.search(line)
+            if line.startswith('----') and 'beginning of' in line:
+                # logcat starts each buffer of the dump with a header,
+                # e.g. '--------- beginning of /dev/log/system'
+                if self.inLogDump:
+                    return MochitestEvent('output', None, None, None, line)
+                self.inLogDump = True
+                return MochitestEvent('log-start', None, None, None, line)
+            if self.inLogDump:
+                if line.startswith('----'):
+                    # the harness closes the dump with a '----' line
+                    self.inLogDump = False
+                    return MochitestEvent('log-end', None, None, None, line)
+                if not match:
+                    self.logLines += 1
+                    return MochitestEvent('output', None, None, None, line)
+                # harness output resumed without a closing line
+                self.inLogDump = False
+            if not match:
+                return MochitestEvent('output', None, None, None, line)
+            status, test, message = match.groups()
+            if status == 'TEST-START':
+                kind = 'start'
+                self.tests += 1
+                self.current = self._result(test)
+            elif status == 'TEST-END':
+                kind = 'end'
+                result = self._result(test)
+                result.duration = time.time() - result.start
+                if self.current is result:
+                    self.current = None
+            elif status in ('TEST-PASS', 'TEST-OK'):
+                kind = 'pass'
+                self.passed += 1
+                self._result(test).passed += 1
+            elif status == 'TEST-KNOWN-FAIL':
+                kind = 'todo'
+                self.todo += 1
+                self._result(test).todo += 1
+            elif status.startswith('TEST-UNEXPECTED-'):
+                kind = 'fail'
+                self.failed += 1
+                result = self._result(test)
+                result.failed += 1
+                if len(result.failures) < result.MAX_FAILURES:
+                    result.failures.append('%s | %s' % (status, message))
+            else:
+                kind = 'info'
+            return MochitestEvent(kind, test, status, message, line)
+
+    def status(self):
+        with self.lock:
+            lines = ['%d tests run: %d passed, %d failed, %d todo' % (
+                     self.tests, self.passed, self.failed, self.todo)]
+            if self.current:
+                lines.append('Running ' + str(self.current))
+            failed = [r for r in self.results.itervalues() if r.failed]
+            if failed:
+                lines.append('Unexpected results:')
+            for result in failed:
+                lines.append('  ' + str(result))
+                lines.extend('    ' + f for f in result.failures)
+            if self.logLines:
+                lines.append('Log dump: %d lines' % self.logLines)
+            return '\n'.join(lines)
+
+class MochitestOutput(threading.Thread):
+    '''Read harness output, parse it, and write the interesting parts
+    to the terminal in batches while the program is running'''
+
+    def __init__(self, proc, parser, breakOnFailure=False):
+        super(MochitestOutput, self).__init__(name='Mochitest')
+        self.daemon = True
+        self.proc = proc
+        self.parser = parser
+        self.breakOnFailure = breakOnFailure
+        self.stats = adblog.LogStats()
+        self.writer = adblog.LogWriter(sys.__stderr__, self.stats,
+                                       'MochitestWriter')
+
+    def run(self):
+        self.writer.start()
+        try:
+            for line in iter(self.proc.stdout.readline, ''):
+                event = self.parser.feed(line)
+                # don't log passing tests or the log dump
+                if event.kind not in ('pass', 'todo', 'log-end') and \
+                        not self.parser.inLogDump and adblog.continuing:
+                    self.writer.write('\x1B[1mout> \x1B[22m' +
+                                      event.line + '\n')
+                if event.kind == 'fail' and self.breakOnFailure and \
+                        adblog.continuing:
+                    self.breakOnFailure = False
+                    self.writer.write('\x1B[1mout> unexpected result; '
+                                      'interrupting\x1B[22m\n', False)
+                    self.writer.flush()
+                    adblog.interrupt()
+            self.proc.wait()
+        finally:
+            self.writer.flush()
+            self.writer.terminate()
+
+# parser of the current or last run, for "mochitest status"
+current = None
+
+def start(proc, parser, breakOnFailure=False):
+    '''Parse further output from the harness process in the background'''
+    global current
+    current = parser
+    output = MochitestOutput(proc, parser, breakOnFailure)
+    output.start()
+    return output
+
+class MochitestCommand(gdb.Command):
+    '''Commands for remote Mochitests started by feninit'''
+
+    def __init__(self):
+        super(MochitestCommand, self).__init__('mochitest',
+                gdb.COMMAND_SUPPORT, gdb.COMPLETE_NONE, True)
+
+    def invoke(self, argument, from_tty):
+        gdb.execute('help mochitest', from_tty)
+
+class MochitestStatus(gdb.Command):
+    '''Show results of the current or last Mochitest run
+
+    Usage: mochitest status'''
+
+    def __init__(self):
+        super(MochitestStatus, self).__init__('mochitest status',
+                gdb.COMMAND_SUPPORT)
+
+    def complete(self, text, word):
+        return gdb.COMPLETE_NONE
+
+    def invoke(self, argument, from_tty):
+        self.dont_repeat()
+        if not current:
+            print 'No Mochitest run.'
+            return
+        print current.status()
+
+mochitest_command = MochitestCommand()
+mochitest_status = MochitestStatus()
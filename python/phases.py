@@ -0,0 +1,127 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import sys, threading
+
+class Phase(object):
+    def __init__(self, name, fn, deps, background):
+        self.name = name
+        self.fn = fn
+        self.deps = deps # Phase objects
+        self.background = background
+        self.started = False
+        self.done = False
+        self.result = None
+        self.error = None # sys.exc_info() if fn raised
+
+class PhaseGraph(object):
+    '''Run phases of work concurrently according to their dependencies
+
+    Phases added with add() run on a pool of worker threads as soon as
+    the phases they depend on are done; their functions are called with
+    the results of those phases, and must not call into gdb or prompt the
+    user. Phases that do need gdb or the user are run on the calling
+    (main) thread with run(), so prompts are never interleaved.'''
+
+    # seconds between checks for Ctrl+C while waiting on the main thread
+    WAIT_INTERVAL = 0.1
+
+    def __init__(self, workers=4):
+        self._cond = threading.Condition()
+        self._phases = {}
+        self._ready = []
+        self._workers = []
+        self._maxWorkers = workers
+        self._idle = 0
+        self._closed = False
+
+    def __contains__(self, name):
+        return name in self._phases
+
+    def _schedule(self):
+        # called with self._cond held; queue phases whose deps are done
+        for phase in self._phases.itervalues():
+            if phase.background and not phase.started and \
+                    all(d.done for d in phase.deps):
+                phase.started = True
+                self._ready.append(phase)
+        if len(self._ready) > self._idle and \
+                len(self._workers) < self._maxWorkers:
+            worker = threading.Thread(name='Phase', target=self._work)
+            worker.daemon = True
+            self._workers.append(worker)
+            worker.start()
+        self._cond.notify_all()
+
+    def _execute(self, phase):
+        try:
+            errors = [d.error for d in phase.deps if d.error]
+            if errors:
+                # fail with the same error as the failed dependency
+                phase.error = errors[0]
+            else:
+                phase.result = phase.fn(*[d.result for d in phase.deps])
+        except:
+            phase.error = sys.exc_info()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._idle += 1
+                while not self._ready and not self._closed:
+                    self._cond.wait()
+                self._idle -= 1
+                if self._closed:
+                    return
+                phase = self._ready.pop(0)
+            self._execute(phase)
+            with self._cond:
+                phase.done = True
+                self._schedule()
+
+    def add(self, name, fn, deps=()):
+        '''Run fn on a worker thread once deps are done'''
+        with self._cond:
+            self._phases[name] = Phase(name, fn,
+                    [self._phases[d] for d in deps], True)
+            self._schedule()
+
+    def _wait(self, phases):
+        with self._cond:
+            while not all(p.done for p in phases):
+                self._cond.wait(self.WAIT_INTERVAL)
+
+    def run(self, name, fn, deps=()):
+        '''Run fn on the calling thread after deps are done'''
+        with self._cond:
+            phase = Phase(name, fn, [self._phases[d] for d in deps], False)
+            phase.started = True
+            self._phases[name] = phase
+        self._wait(phase.deps)
+        self._execute(phase)
+        with self._cond:
+            phase.done = True
+            self._schedule()
+        return self.result(name)
+
+    def result(self, name):
+        '''Wait for a phase and return its result, or raise its error'''
+        phase = self._phases[name]
+        self._wait([phase])
+        if phase.error:
+            raise phase.error[0], phase.error[1], phase.error[2]
+        return phase.result
+
+    def forget(self, name):
+        '''Forget a phase whose result is outdated'''
+        with self._cond:
+            self._phases.pop(name, None)
+
+    def close(self):
+        '''Stop worker threads once they finish their current phase'''
+        with self._cond:
+            self._closed = True
+            self._ready = []
+            self._cond.notify_all()
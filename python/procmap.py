@@ -0,0 +1,138 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import adb, threading, time
+
+class ProcMap(threading.Thread):
+    '''Map of pid/tid to process/thread names, refreshed in the background
+
+    The whole map is read from /proc using one shell command; only shell
+    builtins are used in the loop, so no process is started per pid.'''
+
+    # seconds between refreshes while active
+    REFRESH_INTERVAL = 2.0
+    # minimum seconds between refreshes requested for unknown ids
+    MIN_INTERVAL = 0.5
+
+    SCRIPT = ('cd /proc && for p in [0-9]*; do '
+              'read -r c < $p/cmdline; echo "P $p $c"; '
+              'for t in $p/task/[0-9]*; do '
+              'read -r s < $t/stat; echo "T $p $s"; '
+              'done; done 2>/dev/null')
+
+    def __init__(self):
+        super(ProcMap, self).__init__(name='ProcMap')
+        self.daemon = True
+        self.active = False
+        self.running = True
+        self.generation = 0
+        # pid -> (process name, parent pid)
+        self.processes = {}
+        # tid -> (pid, thread name)
+        self.threads = {}
+        self._children = {}
+        self._followed = {}
+        self._lastRefresh = 0
+        self._wake = threading.Event()
+
+    def _parse(self, out):
+        processes = {}
+        threads = {}
+        parents = {}
+        for line in out.splitlines():
+            kind, sep, rest = line.rstrip('\r').partition(' ')
+            if kind == 'P':
+                pid, sep, cmdline = rest.partition(' ')
+                # use 'plugin-container' for '/path/to/plugin-container'
+                processes[pid] = cmdline.split('\0')[0].strip() \
+                                        .rpartition('/')[2]
+            elif kind == 'T':
+                # rest == 'PID TID (COMM) STATE PPID ...'
+                pid, sep, stat = rest.partition(' ')
+                tid, sep, stat = stat.partition(' (')
+                comm, sep, stat = stat.rpartition(') ')
+                threads[tid] = (pid, comm)
+                fields = stat.split()
+                if tid == pid and len(fields) > 1:
+                    parents[pid] = fields[1]
+        for pid, name in processes.iteritems():
+            # kernel threads have no command line
+            processes[pid] = (name or threads.get(pid, ('', ''))[1],
+                              parents.get(pid))
+        children = {}
+        for pid, (name, ppid) in processes.iteritems():
+            children.setdefault(ppid, []).append(pid)
+        return processes, threads, children
+
+    def refresh(self):
+        self._lastRefresh = time.time()
+        try:
+            out = adb.call(['shell', self.SCRIPT])
+        except Exception:
+            return
+        processes, threads, children = self._parse(out)
+        # replace, instead of update, so readers never need locking
+        self.processes = processes
+        self.threads = threads
+        self._children = children
+        self._followed = {}
+        self.generation += 1
+
+    def request(self):
+        # refresh soon, because an unknown id was seen
+        if time.time() - self._lastRefresh >= self.MIN_INTERVAL:
+            self._wake.set()
+
+    def run(self):
+        while self.running:
+            if self.active or not self.generation:
+                self.refresh()
+            self._wake.wait(self.REFRESH_INTERVAL)
+            self._wake.clear()
+
+    def terminate(self):
+        self.running = False
+        self._wake.set()
+
+    def processName(self, pid):
+        proc = self.processes.get(pid)
+        if proc:
+            return proc[0]
+        self.request()
+        return ''
+
+    def threadName(self, tid):
+        thread = self.threads.get(tid)
+        if thread:
+            return thread[1]
+        self.request()
+        return ''
+
+    def descendants(self, pid):
+        children = self._children
+        pids = set()
+        pending = [pid]
+        while pending:
+            for child in children.get(pending.pop(), []):
+                if child not in pids:
+                    pids.add(child)
+                    pending.append(child)
+        return pids
+
+    def followedPids(self, pid, pkg=None):
+        '''Return pid, its descendants, and if pid is the main process of
+        package pkg, other processes of the package (e.g. pkg:tab)'''
+        followed = self._followed
+        if (pid, pkg) in followed:
+            return followed[(pid, pkg)]
+        pids = self.descendants(pid)
+        pids.add(pid)
+        if pkg and self.processName(pid) == pkg:
+            prefix = pkg + ':'
+            pids.update(p for p, (name, ppid) in self.processes.iteritems()
+                        if name.startswith(prefix))
+        pids = frozenset(pids)
+        followed[(pid, pkg)] = pids
+        return pids
@@ -0,0 +1,140 @@
+# vi: set tabstop=4 shiftwidth=4 expandtab:
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import adb, collections, re, threading, time
+
+# one 'ps' line; state is e.g. 'S' (sleeping) or 'T' (stopped)
+Process = collections.namedtuple('Process',
+        ['pid', 'ppid', 'state', 'name', 'line'])
+
+class ProcessWatcher(threading.Thread):
+    '''Watch the processes of a package using one long-lived shell
+
+    The device runs a loop that only prints the package's 'ps' lines when
+    they change, so the host does not poll or parse the process table.
+    The wait methods block until the processes reach some state.'''
+
+    # seconds between checks on the device
+    INTERVAL = 0.2
+    # seconds between checks for Ctrl+C while waiting
+    WAIT_INTERVAL = 0.1
+
+    # uses only shell builtins besides ps and sleep, which may only
+    # support whole seconds on older devices; the pattern is only a
+    # prefilter, and _parse checks the exact name
+    SCRIPT = ('o=; while :; do '
+              'n=$(ps | while read -r l; do '
+              'case "$l" in *%(pkg)s*) echo "$l";; esac; done); '
+              'if [ "$n" != "$o" ]; then echo "$n"; echo @@; o=$n; fi; '
+              'sleep %(interval)s 2>/dev/null || sleep 1; done')
+
+    def __init__(self, pkg):
+        super(ProcessWatcher, self).__init__(name='ProcessWatcher')
+        self.daemon = True
+        # full process name, e.g. a web app's 'pkg:pkg.WebApp0'
+        self.pkg = pkg
+        self.running = True
+        self.generation = 0
+        # list of Process for the package
+        self.procs = []
+        self._cond = threading.Condition()
+        self._listeners = []
+        self._shell = None
+
+    def _parse(self, lines):
+        procs = []
+        for line in lines:
+            cols = line.split()
+            # USER PID PPID ... S NAME
+            if len(cols) < 5 or not cols[1].isdigit():
+                continue
+            # the device only matches a substring, so e.g. watching
+            # org.mozilla.fennec also gets org.mozilla.fennec_aurora;
+            # keep processes that have the full name as a token
+            if self.pkg not in re.split(r'[ \t/]', line):
+                continue
+            procs.append(Process(cols[1], cols[2], cols[-2], cols[-1], line))
+        return procs
+
+    def run(self):
+        try:
+            self._shell = adb.call(['shell', self.SCRIPT % {
+                    'pkg': self.pkg, 'interval': self.INTERVAL}],
+                    async=True)
+            lines = []
+            for line in iter(self._shell.stdout.readline, ''):
+                line = line.rstrip('\r\n')
+                if line != '@@':
+                    lines.append(line)
+                    continue
+                procs = self._parse(lines)
+                lines = []
+                with self._cond:
+                    old = self.procs
+                    self.procs = procs
+                    self.generation += 1
+                    self._cond.notify_all()
+                for listener in self._listeners:
+                    listener(old, procs)
+        finally:
+            with self._cond:
+                self.running = False
+                self._cond.notify_all()
+
+    def terminate(self):
+        self.running = False
+        if self._shell and self._shell.poll() is None:
+            self._shell.terminate()
+
+    def addListener(self, fn):
+        '''Call fn(oldProcs, newProcs) on the watcher thread after changes'''
+        self._listeners = self._listeners + [fn]
+
+    def removeListener(self, fn):
+        self._listeners = [l for l in self._listeners if l is not fn]
+
+    def waitFor(self, predicate, timeout=None):
+        '''Wait until predicate(procs) returns a true value, and return
+        that value; return None on timeout or if the watcher stopped'''
+        end = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                # the first snapshot has not arrived yet
+                if self.generation:
+                    result = predicate(self.procs)
+                    if result:
+                        return result
+                if not self.running:
+                    return None
+                wait = self.WAIT_INTERVAL
+                if end is not None:
+                    wait = min(wait, end - time.time())
+                    if wait <= 0:
+                        return None
+                self._cond.wait(wait)
+
+    def waiting(self, procs=None):
+        '''Return processes that are waiting ('S' or 'T' state)'''
+        return [p for p in (self.procs if procs is None else procs)
+                if p.state in ('S', 'T')]
+
+    def waitForParent(self, childName, timeout=None):
+        '''Wait for the package's main process to finish launching, and
+        return all waiting processes'''
+        def started(procs):
+            waiting = self.waiting(procs)
+            if any(childName not in p.name for p in waiting):
+                return waiting
+        return self.waitFor(started, timeout)
+
+    def waitForChildren(self, ppid, childName, timeout=None):
+        '''Wait for at least one child process of ppid'''
+        return self.waitFor(lambda procs: [p for p in self.waiting(procs)
+                if p.ppid == ppid and childName in p.name], timeout)
+
+    def waitForExit(self, pids=None, timeout=None):
+        '''Wait for the given pids, or all the package's processes, to exit'''
+        return bool(self.waitFor(lambda procs: not any(
+                pids is None or p.pid in pids for p in procs), timeout))
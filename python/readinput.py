@@ -3,12 +3,15 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import sys, os
+import sys, os, json
 
 if __name__ == '__main__': # not module
 
-    import readline, shlex
-    from optparse import OptionParser
+    # runs as a helper process that reads prompt requests, one JSON
+    # object per line, from the file descriptor in argv[1], and writes
+    # responses to the file descriptor in argv[2]
+
+    import readline, shlex, signal, stat
 
     if 'libedit' in readline.__doc__:
         readline.parse_and_bind('bind ^I rl_complete')
@@ -46,119 +49,213 @@ if __name__ == '__main__': # not module
                buf[preend: poststart], \
                buf[poststart: postend]
 
-    def dirComplete(text, state):
-        pre, word, post = getLine()
-        comps = safeSplit(pre + word)
-        path = comps[-1] if comps else ''
-        basename = os.path.basename(path)
-        dirname = os.path.dirname(path)
-        abspath = os.path.abspath(os.path.expanduser(dirname))
-        for d in os.listdir(abspath):
-            if 'libedit' not in readline.__doc__:
-                if not d.lower().startswith(basename.lower()):
-                    continue
-            else:
-                if not d.startswith(basename):
-                    continue
-            if d.startswith('.') and not basename.startswith('.'):
-                continue
-            if not os.path.isdir(os.path.join(abspath, d)):
+    # directory listings as (mtime, [(name, is dir, mode)]) by path;
+    # a listing is reused until the directory's mtime changes
+    listings = {}
+
+    def listDir(abspath):
+        try:
+            mtime = os.stat(abspath).st_mtime
+        except OSError:
+            return []
+        listing = listings.get(abspath)
+        if listing and listing[0] == mtime:
+            return listing[1]
+        entries = []
+        for name in os.listdir(abspath):
+            try:
+                mode = os.stat(os.path.join(abspath, name)).st_mode
+            except OSError:
                 continue
-            if not state:
-                return pre + d + os.path.sep + post
-            state -= 1
-        return None
+            entries.append((name, stat.S_ISDIR(mode), mode))
+        listings[abspath] = (mtime, entries)
+        return entries
+
+    # options of the current request
+    options = {'list': [], 'fileMode': 0, 'fileModeMask': 0}
 
-    def fileComplete(text, state):
+    def pathMatches(dirsOnly):
         pre, word, post = getLine()
         comps = safeSplit(pre + word)
         path = comps[-1] if comps else ''
         basename = os.path.basename(path)
         dirname = os.path.dirname(path)
         abspath = os.path.abspath(os.path.expanduser(dirname))
-        for f in os.listdir(abspath):
+        fm = options['fileMode']
+        fmm = options['fileModeMask']
+        matches = []
+        for name, isdir, mode in listDir(abspath):
             if 'libedit' not in readline.__doc__:
-                if not f.lower().startswith(basename.lower()):
+                if not name.lower().startswith(basename.lower()):
                     continue
             else:
-                if not f.startswith(basename):
+                if not name.startswith(basename):
                     continue
-            if f.startswith('.') and not basename.startswith('.'):
+            if name.startswith('.') and not basename.startswith('.'):
                 continue
-            if os.path.isdir(os.path.join(abspath, f)):
-                if not state:
-                    return pre + f + os.path.sep + post
-                state -= 1
-            elif os.stat(os.path.join(abspath, f)).st_mode & fmm == fm:
-                if not state:
-                    return pre + f + post
-                state -= 1
-        return None
-
-    def listComplete(text, state):
+            if isdir:
+                matches.append(pre + name + os.path.sep + post)
+            elif not dirsOnly and mode & fmm == fm:
+                matches.append(pre + name + post)
+        return matches
+
+    def listMatches():
         buf = readline.get_line_buffer().lower()
-        results = [x for x in lst if x.lower().startswith(buf)] + [None]
-        return results[state]
-
-    parser = OptionParser()
-    parser.add_option('-p', dest='p')
-    parser.add_option('-l', dest='l')
-    parser.add_option('-d', action='store_true', dest='d')
-    parser.add_option('-f', action='store_true', dest='f')
-    parser.add_option('-c', dest='c')
-    parser.add_option('--file-mode', dest='fm')
-    parser.add_option('--file-mode-mask', dest='fmm')
-    (args, extras) = parser.parse_args()
-
-    if hasattr(args, 'l') and args.l:
-        lst = eval(args.l)
-        readline.set_completer_delims('')
-        readline.set_completer(listComplete)
-    elif hasattr(args, 'd') and args.d:
-        if 'libedit' in readline.__doc__:
-            readline.set_completer_delims(''.join(DEFAULT_DELIMS))
-        else:
-            readline.set_completer_delims(''.join(PATH_DELIMS))
-        readline.set_completer(dirComplete)
-    elif hasattr(args, 'f') and args.f:
-        if 'libedit' in readline.__doc__:
-            readline.set_completer_delims(''.join(DEFAULT_DELIMS))
+        return [x for x in options['list'] if x.lower().startswith(buf)]
+
+    def makeCompleter(getMatches):
+        # readline asks for matches one state at a time;
+        # compute all of them once, when state is 0
+        matches = []
+        def complete(text, state):
+            if not state:
+                matches[:] = getMatches()
+            return matches[state] if state < len(matches) else None
+        return complete
+
+    dirComplete = makeCompleter(lambda: pathMatches(True))
+    fileComplete = makeCompleter(lambda: pathMatches(False))
+    listComplete = makeCompleter(listMatches)
+
+    startdir = os.getcwd()
+
+    def readInput(request):
+        if hasattr(readline, 'clear_history'):
+            readline.clear_history()
+        isDir = request.get('dir')
+        isFile = request.get('file')
+        if request.get('list') is not None:
+            options['list'] = [x.encode('utf-8') for x in request['list']]
+            readline.set_completer_delims('')
+            readline.set_completer(listComplete)
+        elif isDir or isFile:
+            if 'libedit' in readline.__doc__:
+                readline.set_completer_delims(''.join(DEFAULT_DELIMS))
+            else:
+                readline.set_completer_delims(''.join(PATH_DELIMS))
+            readline.set_completer(dirComplete if isDir else fileComplete)
         else:
-            readline.set_completer_delims(''.join(PATH_DELIMS))
-        readline.set_completer(fileComplete)
-    curdir = None
-    if hasattr(args, 'c') and args.c:
-        os.chdir(os.path.abspath(os.path.expanduser(args.c)))
-    fm = 0
-    fmm = 0
-    if hasattr(args, 'fm') and args.fm:
-        fm = eval(args.fm)
-        fmm = eval(args.fmm if hasattr(args, 'fmm') and args.fmm
-                            else -1)
-
-    out = raw_input('' if not hasattr(args, 'p') else args.p)
-    relout = os.path.abspath(os.path.expanduser(out)) if out else ''
-    if hasattr(args, 'd') and args.d and os.path.isdir(relout):
-        out = relout
-    elif hasattr(args, 'f') and args.f and os.path.isfile(relout):
-        out = relout
-    sys.stderr.write(out)
+            readline.set_completer()
+        os.chdir(startdir)
+        if request.get('cwd'):
+            os.chdir(os.path.abspath(os.path.expanduser(request['cwd'])))
+        options['fileMode'] = request.get('fileMode', 0)
+        options['fileModeMask'] = request.get('fileModeMask',
+                -1 if 'fileMode' in request else 0)
+
+        out = raw_input(request.get('prompt', '').encode('utf-8'))
+        relout = os.path.abspath(os.path.expanduser(out)) if out else ''
+        if isDir and os.path.isdir(relout):
+            out = relout
+        elif isFile and os.path.isfile(relout):
+            out = relout
+        return out
+
+    requests = os.fdopen(int(sys.argv[1]), 'r')
+    responses = os.fdopen(int(sys.argv[2]), 'w')
+    while True:
+        # Ctrl+C in gdb also reaches this process; only let it
+        # interrupt a prompt, not the wait for the next request
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        line = requests.readline()
+        if not line:
+            break
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            response = {'out': readInput(json.loads(line))}
+        except KeyboardInterrupt:
+            sys.stdout.write('\n')
+            response = {'error': 'interrupted'}
+        except EOFError:
+            sys.stdout.write('\n')
+            response = {'error': 'end of input'}
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        responses.write(json.dumps(response) + '\n')
+        responses.flush()
 
 else:
 
-    import gdb, subprocess
+    import gdb, subprocess, threading, ast, fcntl
+
+    # the helper process; started once and reused for every prompt
+    _helper = None
+    _lock = threading.Lock()
+
+    def start():
+        '''Start the helper process ahead of the first prompt'''
+        global _helper
+        with _lock:
+            if _helper and _helper.poll() is None:
+                return _helper
+            reqRead, reqWrite = os.pipe()
+            respRead, respWrite = os.pipe()
+            # keep our ends out of the helper and other subprocesses
+            for fd in (reqWrite, respRead):
+                fcntl.fcntl(fd, fcntl.F_SETFD,
+                            fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            try:
+                proc = subprocess.Popen([sys.executable,
+                        os.path.join(gdb.PYTHONDIR, 'readinput.py'),
+                        str(reqRead), str(respWrite)])
+            except OSError, e:
+                os.close(reqWrite)
+                os.close(respRead)
+                raise gdb.GdbError('cannot run readinput: ' + str(e))
+            finally:
+                os.close(reqRead)
+                os.close(respWrite)
+            proc.requests = os.fdopen(reqWrite, 'w')
+            proc.responses = os.fdopen(respRead, 'r')
+            _helper = proc
+            return proc
+
+    def _mode(value):
+        return value if isinstance(value, (int, long)) else int(value, 0)
 
     def call(prompt, *args):
-        cmd = [sys.executable, os.path.join(gdb.PYTHONDIR, 'readinput.py'),
-                '-p', prompt]
-        cmd.extend(list(args))
-        try:
-            proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
-            out = proc.communicate()[1]
-        except OSError, e:
-            raise gdb.GdbError('cannot run readinput: ' + str(e))
-        if proc.returncode != 0:
-            raise gdb.GdbError('readinput returned exit code ' +
-                                str(proc.returncode))
-        return out
+        '''Prompt for input with completion
+
+        -l LIST      complete from LIST, a list of strings
+        -d           complete directory names
+        -f           complete file names
+        -c DIR       complete paths relative to DIR
+        --file-mode MODE, --file-mode-mask MASK
+                     only complete files where (mode & MASK) == MODE'''
+        request = {'prompt': prompt}
+        args = list(args)
+        while args:
+            opt = args.pop(0)
+            if opt == '-l':
+                lst = args.pop(0)
+                if isinstance(lst, basestring):
+                    # string form of a list, as in str(['yes', 'no'])
+                    lst = ast.literal_eval(lst)
+                request['list'] = [str(x) for x in lst]
+            elif opt == '-d':
+                request['dir'] = True
+            elif opt == '-f':
+                request['file'] = True
+            elif opt == '-c':
+                request['cwd'] = args.pop(0)
+            elif opt == '--file-mode':
+                request['fileMode'] = _mode(args.pop(0))
+            elif opt == '--file-mode-mask':
+                request['fileModeMask'] = _mode(args.pop(0))
+            else:
+                raise gdb.GdbError('readinput: unknown option ' + opt)
 
+        proc = start()
+        with _lock:
+            try:
+                proc.requests.write(json.dumps(request) + '\n')
+                proc.requests.flush()
+                response = proc.responses.readline()
+            except IOError:
+                response = ''
+        if not response:
+            raise gdb.GdbError('readinput exited with code ' +
+                               str(proc.wait()))
+        response = json.loads(response)
+        if 'error' in response:
+            raise gdb.GdbError('readinput: ' + response['error'])
+        return response['out'].encode('utf-8')
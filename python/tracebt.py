@@ -3,7 +3,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import gdb, re, logging, os
+import gdb, lazy, re, logging, os
 
 class LogLimiter:
     def __init__(self):
@@ -395,3 +395,4 @@ class TraceBT(gdb.Command):
         print 'no more reachable frames'
 
 default = TraceBT()
+lazy.bind(__name__, default)
@@ -3,17 +3,29 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import gdb, readinput
-import os, subprocess, time
+import gdb, lazy
+import os, subprocess, threading, time
 
 class Updater(gdb.Command):
-    '''Update gdb/gdbutils'''
+    '''Update gdb/gdbutils
+
+    Usage: update-gdbutils [status|apply|force]
+
+Without arguments, check for updates in the background if the update
+interval has passed; the result is shown at the next prompt.
+"status" shows the result of the last check, "apply" updates and exits
+gdb, and "force" checks for updates now.'''
 
     def __init__(self):
         super(Updater, self).__init__('update-gdbutils', gdb.COMMAND_SUPPORT)
+        self._checker = None
+        self._status = None
+        # whether _report is connected to before_prompt
+        self._reporting = False
 
     def complete(self, text, word):
-        return gdb.COMPLETE_NONE
+        return [c for c in ['status', 'apply', 'force']
+                if c.startswith(word)]
 
     def _callGit(self, args, **kw):
         cmd = ['git', '--work-tree=' + self.worktree,
@@ -58,20 +70,66 @@ class Updater(gdb.Command):
         print '\nUpdated successfully. Please restart gdb.'
         gdb.execute('quit')
 
-    def invoke(self, argument, from_tty):
-        self.dont_repeat()
+    def _fetch(self):
+        # runs on the checker thread, so it must not use gdb
+        try:
+            with open(os.devnull, 'r+') as devnull:
+                # fail instead of asking for credentials
+                self._callGit(['fetch', '--quiet'],
+                              stdin=devnull, stderr=devnull,
+                              env=dict(os.environ, GIT_TERMINAL_PROMPT='0'))
+                count = self._callGit(['rev-list', '--count',
+                                       'HEAD..@{upstream}'],
+                                      stdin=devnull, stderr=devnull).strip()
+            count = int(count) if count.isdigit() else 0
+            if count:
+                self._status = ('%d new commit%s available; use '
+                        '"update-gdbutils apply" to update.' %
+                        (count, 's' if count > 1 else ''))
+            else:
+                self._status = 'gdbutils is up to date.'
+            self._available = bool(count)
+        except Exception as e:
+            self._status = 'Could not check for updates: ' + str(e)
+            self._available = False
 
-        interval = (self.update_interval
-                if hasattr(self, 'update_interval') else 90)
-        if argument and argument.strip() == 'force':
-            interval = -1
-        if not interval:
+    def _startCheck(self):
+        if self._checker and self._checker.isAlive():
+            return
+        self._status = 'Checking for updates...'
+        self._available = False
+        self._checker = threading.Thread(name='Updater', target=self._fetch)
+        self._checker.daemon = True
+        self._checker.start()
+        # report updates at the first prompt after the check is done
+        if hasattr(gdb.events, 'before_prompt') and not self._reporting:
+            gdb.events.before_prompt.connect(self._report)
+            self._reporting = True
+
+    def _report(self):
+        if self._checker.isAlive():
             return
+        gdb.events.before_prompt.disconnect(self._report)
+        self._reporting = False
+        if self._available:
+            print self._status
 
+    def _setPaths(self):
+        # returns False if gdbutils is not a git checkout
         self.worktree = os.path.abspath(
                 os.path.join(gdb.PYTHONDIR, os.path.pardir))
         self.gitdir = os.path.join(self.worktree, '.git')
-        if not os.path.isdir(self.gitdir):
+        return os.path.isdir(self.gitdir)
+
+    def invoke(self, argument, from_tty):
+        self.dont_repeat()
+
+        argument = argument.strip() if argument else ''
+        if argument not in ('', 'status', 'apply', 'force'):
+            raise gdb.GdbError('Usage: update-gdbutils [status|apply|force]')
+        if not self._setPaths():
+            if argument:
+                print 'gdbutils is not a git checkout.'
             return
 
         marker = os.path.join(self.worktree, '.update')
@@ -79,25 +137,44 @@ class Updater(gdb.Command):
             with open(marker, 'a'):
                 os.utime(marker, None)
 
-        if interval > 0 and not os.path.isfile(marker):
+        if argument == 'status':
+            if self._status:
+                print self._status
+            else:
+                print 'No update check since gdb started.'
+            if os.path.isfile(marker):
+                print 'Last checked %d days ago.' % ((time.time() -
+                        os.path.getmtime(marker)) / 60 / 60 / 24)
+            return
+        if argument == 'apply':
+            if self._checker and self._checker.isAlive():
+                print 'Waiting for update check... '
+                self._checker.join()
+            self._checkUpdate()
+            print 'gdbutils is up to date.'
+            return
+        if argument == 'force':
+            touchUpdate()
+            self._startCheck()
+            print self._status
+            return
+
+        interval = (self.update_interval
+                if hasattr(self, 'update_interval') else 90)
+        if not interval:
+            return
+
+        if not os.path.isfile(marker):
             touchUpdate()
             return
 
         elapsed = time.time() - os.path.getmtime(marker)
         if elapsed >= interval * 24 * 60 * 60:
-            ans = '' if interval > 0 else 'y'
-            while not ans or (ans[0] != 'y' and ans[0] != 'Y' and
-                              ans[0] != 'n' and ans[0] != 'N'):
-                print
-                ans = readinput.call(
-                    'Last checked for update %d days ago; '
-                    'check now? [yes/no]: ' %
-                    (elapsed / 60 / 60 / 24),
-                    '-l', str(['yes', 'no']))
-            if ans[0] == 'y' or ans[0] == 'Y':
-                self._checkUpdate()
-            # update timestamp regardless of choice above
+            # update timestamp when starting to check, so a failed check
+            # is not retried on every start
             touchUpdate()
+            self._startCheck()
 
 default = Updater()
+lazy.bind(__name__, default)
 